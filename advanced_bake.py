@@ -3,6 +3,19 @@
 import bpy
 import mathutils
 import math
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bake_filters import (read_uv_triangles, rasterize_uv_coverage, downsample_masked, mip_pyramid,
+                          estimate_noise, linear_to_srgb)
+from bake_profile import PipelineProfiler
 
 # === 配置区域 ===
 INPUT_GLB = r"F:\AI\datasets\objaverse_result\batch_test_baked\00c2112c133a4b548a3ef3b01b009286_baked.glb"
@@ -17,6 +30,20 @@ AREA_SIZE_Y = 0.06       # 面积光 Y 维度（米）
 AREA_COLOR = (1.0, 0.937, 0.882)  # 面积光颜色 (R, G, B)
 HDR_IMAGE = r"F:\AI\datasets\objaverse_result\abandoned_church_1k.hdr"  # 新增：指定 HDR 环境贴图路径
 OFFSET_RATIO = 1.0      # 相机位置偏移比例
+SUPERSAMPLE = 1         # 超采样倍数：在 k 倍分辨率烘焙后按 UV 岛屿掩码降采样（1 表示关闭）
+SS_FILTER = 'lanczos'   # 降采样滤波器：'box' 或 'lanczos'
+EXPORT_MIPS = False     # 是否为每张烘焙图额外保存 mip 链
+# 质量 / 时间预算：None 使用 Cycles 默认采样；否则开启自适应采样、限制每张采样数，并按需做 OIDN 降噪
+QUALITY_BUDGET = None   # 'draft' / 'balanced' / 'final'
+DENOISE_MEAN_TOL = 0.02  # 降噪前后岛屿内平均颜色允许的最大偏移，超过则保留未降噪结果
+NUM_SHARDS = 1          # 镜头分片数：>1 时把 (仰角, 旋转) 网格分给多个 Blender 子进程并行烘焙
+SEED = 0                # 旋转抖动的固定随机种子，保证分片前后结果一致
+BUDGET_PRESETS = {
+    #             最大采样  最小采样  噪声阈值  OIDN 降噪
+    'draft':    dict(max_samples=32,  min_samples=8,  noise_threshold=0.05,  denoise=True),
+    'balanced': dict(max_samples=128, min_samples=16, noise_threshold=0.02,  denoise=True),
+    'final':    dict(max_samples=512, min_samples=32, noise_threshold=0.005, denoise=True),
+}
 
 # === 功能函数 ===
 def clear_scene():
@@ -188,6 +215,96 @@ def save_image(img, path):
     img.save()
 
 
+def uv_island_mask(obj, res):
+    me = obj.data
+    return rasterize_uv_coverage(read_uv_triangles(me, me.uv_layers.active.name), res, res) > 0
+
+
+def downsample_bake_image(obj, img, k):
+    """把 k 倍分辨率的烘焙图按 UV 岛屿掩码降采样，返回 (新图像, 像素, 覆盖率)"""
+    hi_res = img.size[0]
+    res = hi_res // k
+    pixels = np.empty(hi_res * hi_res * 4, dtype=np.float32)
+    img.pixels.foreach_get(pixels)
+    out, coverage = downsample_masked(pixels.reshape(hi_res, hi_res, 4), uv_island_mask(obj, hi_res), k, SS_FILTER)
+    low = bpy.data.images.new(f"{img.name}_x{k}", width=res, height=res)
+    low.pixels.foreach_set(out.ravel())
+    return low, out, coverage
+
+
+def save_mips(img, pixels, coverage, path):
+    """保存 mip 链（第 1 级起）：<path>_mip<N>.png"""
+    for level, px in enumerate(mip_pyramid(pixels, coverage), start=1):
+        h, w = px.shape[:2]
+        mip = bpy.data.images.new(f"{img.name}_mip{level}", width=w, height=h)
+        mip.pixels.foreach_set(px.ravel())
+        save_image(mip, path.replace('.png', f'_mip{level}.png'))
+        bpy.data.images.remove(mip)
+
+
+def apply_sampling_budget(scene, budget):
+    """开启自适应采样并限制每张烘焙的采样数"""
+    scene.cycles.use_adaptive_sampling = True
+    scene.cycles.adaptive_threshold = budget['noise_threshold']
+    scene.cycles.adaptive_min_samples = budget['min_samples']
+    scene.cycles.samples = budget['max_samples']
+    # 烘焙不走渲染降噪，降噪在烘焙后对图像单独做
+    scene.cycles.use_denoising = False
+
+
+def denoise_image(img, mask):
+    """用合成器的 Denoise 节点（OpenImageDenoise，CPU）对烘焙图降噪，结果写回 img。
+    合成树中没有 Render Layers 节点，render() 只执行合成，不会重新渲染场景。
+    合成器输出是线性值，写回 sRGB 字节图前要重新编码。
+    降噪不应改变岛屿内的平均颜色：偏移超过 DENOISE_MEAN_TOL 时视为出错，保留原图。
+    返回岛屿内平均颜色的偏移"""
+    scene = bpy.context.scene
+    w, h = img.size
+    scene.render.resolution_x = w
+    scene.render.resolution_y = h
+    scene.render.resolution_percentage = 100
+    scene.use_nodes = True
+    tree = scene.node_tree
+    tree.nodes.clear()
+    src = tree.nodes.new(type='CompositorNodeImage')
+    src.image = img
+    dn = tree.nodes.new(type='CompositorNodeDenoise')
+    comp = tree.nodes.new(type='CompositorNodeComposite')
+    viewer = tree.nodes.new(type='CompositorNodeViewer')
+    tree.links.new(src.outputs['Image'], dn.inputs['Image'])
+    tree.links.new(dn.outputs['Image'], comp.inputs['Image'])
+    tree.links.new(dn.outputs['Image'], viewer.inputs['Image'])
+    bpy.ops.render.render()
+
+    result = np.empty(w * h * 4, dtype=np.float32)
+    bpy.data.images['Viewer Node'].pixels.foreach_get(result)
+    scene.use_nodes = False
+    rgb = np.clip(result.reshape(-1, 4)[:, :3], 0.0, 1.0)
+    if not img.is_float and img.colorspace_settings.name == 'sRGB':
+        rgb = linear_to_srgb(rgb)
+    pixels = np.empty(w * h * 4, dtype=np.float32)
+    img.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(-1, 4)
+    island = mask.ravel()
+    if not island.any():
+        return 0.0
+    shift = float(np.abs(rgb[island].mean(axis=0) - pixels[island, :3].mean(axis=0)).max())
+    if shift > DENOISE_MEAN_TOL:
+        print(f"Warning: 降噪后岛屿平均颜色偏移 {shift:.4f}，保留未降噪的结果")
+        return shift
+    # 只替换 RGB，保留烘焙的 alpha
+    pixels[:, :3] = rgb
+    img.pixels.foreach_set(pixels.ravel())
+    return shift
+
+
+def image_noise(obj, img):
+    res = img.size[0]
+    pixels = np.empty(res * res * 4, dtype=np.float32)
+    img.pixels.foreach_get(pixels)
+    return estimate_noise(pixels.reshape(res, res, 4), uv_island_mask(obj, res))
+
+
 def save_blend(path):
     bpy.ops.wm.save_mainfile(filepath=path)
 
@@ -253,9 +370,33 @@ def compute_bounding_box(obj):
     return min_co, max_co
 
 # === 主流程 ===
-def main():
+def shot_grid(seed):
+    """(elevation, rotation) 网格上的全部镜头：[(shot, vid, elev, i, 旋转角)]。
+    抖动在完整网格上按固定种子顺序生成，与分片方式无关，保证可复现"""
+    elevations = [math.atan(0.2), math.atan(1.0)]
+    angle_noise = math.radians(2)  # ±2° 物体旋转微扰
+    rng = random.Random(seed)
+    shots = []
+    for vid, elev in enumerate(elevations):
+        # 在此相机位置上，让物体自转 60° 步长，共拍摄 6 张
+        for i in range(6):
+            base_angle = math.radians(60 * i)
+            delta = rng.uniform(-angle_noise, angle_noise)
+            shots.append((len(shots), vid, elev, i, base_angle + delta))
+    return shots
+
+
+def run_shots(shots):
+    """加载模型与环境一次，依次烘焙给定镜头，返回每个镜头的记录"""
     clear_scene()
     enable_gpu()
+    scene = bpy.context.scene
+    budget = BUDGET_PRESETS[QUALITY_BUDGET] if QUALITY_BUDGET else None
+    if budget:
+        apply_sampling_budget(scene, budget)
+    if SUPERSAMPLE > 1:
+        # 每个输出像素的总采样数保持不变：k² 个子像素各分到 1/k² 的采样
+        scene.cycles.samples = max(1, scene.cycles.samples // (SUPERSAMPLE * SUPERSAMPLE))
     # 导入 glb 模型
     obj = import_model(INPUT_GLB)
     obj.rotation_mode = 'XYZ'
@@ -279,51 +420,138 @@ def main():
     area_light = add_area_light(bpy.context.scene, cam, AREA_POWER, AREA_SIZE_X, AREA_SIZE_Y, AREA_COLOR)
 
     # 固定相机在两个预设位置（各方案第一个点），不随旋转改变
-    elevations = [math.atan(0.2), math.atan(1.0)]
     base_azim = math.radians(180)  # 初始方位角（背面）
-    import random
-    angle_noise = math.radians(2)  # ±2° 物体旋转微扰
-    shot = 0
-    for vid, elev in enumerate(elevations):
-        # 计算并设置固定相机位置
-        horiz = math.cos(elev)
-        direction = mathutils.Vector((
-            math.cos(base_azim) * horiz,
-            math.sin(base_azim) * horiz,
-            math.sin(elev)
-        ))
-        cam_d = radius / math.sin(cam.data.angle / 2) * (1 + OFFSET_RATIO)
-        cam.location = center + direction * cam_d
-        cam.rotation_euler = (center - cam.location).to_track_quat('-Z', 'Y').to_euler()
-        bpy.context.scene.camera = cam
-        # 同步面积光
-        area_light.location = cam.location
-        area_light.rotation_euler = cam.rotation_euler
+    records = []
+    current_vid = None
+    for shot, vid, elev, i, rot_z in shots:
+        if vid != current_vid:
+            # 计算并设置固定相机位置
+            horiz = math.cos(elev)
+            direction = mathutils.Vector((
+                math.cos(base_azim) * horiz,
+                math.sin(base_azim) * horiz,
+                math.sin(elev)
+            ))
+            cam_d = radius / math.sin(cam.data.angle / 2) * (1 + OFFSET_RATIO)
+            cam.location = center + direction * cam_d
+            cam.rotation_euler = (center - cam.location).to_track_quat('-Z', 'Y').to_euler()
+            bpy.context.scene.camera = cam
+            # 同步面积光
+            area_light.location = cam.location
+            area_light.rotation_euler = cam.rotation_euler
+            current_vid = vid
+
+        obj.rotation_euler.z = rot_z
+        # 更新相机位置节点（位置不变，可选执行）
+        mat = obj.data.materials[0]
+        nodes = mat.node_tree.nodes
+        for name, val in [('CamX', cam.location.x), ('CamY', cam.location.y), ('CamZ', cam.location.z)]:
+            if name in nodes:
+                nodes[name].outputs[0].default_value = val
+
+        # 烘焙并保存
+        img = create_bake_image(RESOLUTION * SUPERSAMPLE)
+        attach_texture_node(obj, img, cam)
+        t0 = time.perf_counter()
+        bake_to_image(obj, cam, PADDING * SUPERSAMPLE)
+        bake_time = time.perf_counter() - t0
+        report = f"bake {bake_time:.2f}s"
+        if budget:
+            noise = image_noise(obj, img)
+            report += f", samples≤{scene.cycles.samples}, noise σ={noise:.4f}"
+            if budget['denoise']:
+                t0 = time.perf_counter()
+                shift = denoise_image(img, uv_island_mask(obj, img.size[0]))
+                report += (f", denoise {time.perf_counter() - t0:.2f}s → σ={image_noise(obj, img):.4f}"
+                           f" (Δmean {shift:.4f})")
+        out_img = OUTPUT_IMAGE.replace('.png', f'_{vid}_{i}.png')
+        out_blend = OUTPUT_BLEND.replace('.blend', f'_{vid}_{i}.blend')
+        if SUPERSAMPLE > 1:
+            img, pixels, coverage = downsample_bake_image(obj, img, SUPERSAMPLE)
+        elif EXPORT_MIPS:
+            pixels = np.empty(RESOLUTION * RESOLUTION * 4, dtype=np.float32)
+            img.pixels.foreach_get(pixels)
+            pixels = pixels.reshape(RESOLUTION, RESOLUTION, 4)
+            coverage = uv_island_mask(obj, RESOLUTION)
+        save_image(img, out_img)
+        if EXPORT_MIPS:
+            save_mips(img, pixels, coverage, out_img)
+        save_blend(out_blend)
+        print(f"[Shot {shot}] CameraIdx: {vid}, ObjRot: {obj.rotation_euler}, {report}")
+        records.append({'shot': shot, 'view': vid, 'index': i, 'rotation_z': rot_z,
+                        'image': out_img, 'blend': out_blend, 'report': report})
+    return records
+
+
+def run_sharded(num_shards, seed, profile=False):
+    """把镜头网格按轮转分给 num_shards 个 Blender 子进程，每个进程只加载一次模型；
+    结果按镜头序号合并，写入 <OUTPUT_IMAGE>_shots.json"""
+    threads = max(1, (os.cpu_count() or 1) // num_shards)
+    procs = []
+    for k in range(num_shards):
+        # 清掉上次运行残留的分片清单，否则崩溃的分片会被旧结果掩盖
+        manifest = OUTPUT_IMAGE.replace('.png', f'_shard{k}.json')
+        if os.path.exists(manifest):
+            os.remove(manifest)
+        cmd = [
+            bpy.app.binary_path,
+            "--background",
+            "--python-exit-code", "1",   # 脚本抛异常时 Blender 默认仍以 0 退出
+            "--threads", str(threads),
+            "--python", os.path.abspath(__file__),
+            "--",
+            "--shard", str(k),
+            "--num_shards", str(num_shards),
+            "--seed", str(seed),
+        ]
+        if profile:
+            cmd.append("--profile")
+        procs.append(subprocess.Popen(cmd))
+
+    failed = [k for k, proc in enumerate(procs) if proc.wait() != 0]
+    records = []
+    for k in range(num_shards):
+        manifest = OUTPUT_IMAGE.replace('.png', f'_shard{k}.json')
+        if not os.path.exists(manifest):
+            if k not in failed:
+                failed.append(k)
+            continue
+        with open(manifest, 'r', encoding='utf-8') as f:
+            records.extend(json.load(f))
+        os.remove(manifest)
+    records.sort(key=lambda r: r['shot'])
+    with open(OUTPUT_IMAGE.replace('.png', '_shots.json'), 'w', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False, indent=2)
+    for r in records:
+        print(f"[Shot {r['shot']}] CameraIdx: {r['view']}, RotZ: {r['rotation_z']:.4f}, {r['report']}")
+    if failed:
+        print(f"Shards failed: {sorted(failed)}", file=sys.stderr)
+        sys.exit(1)
 
-        # 在此相机位置上，让物体自转 60° 步长，共拍摄 6 张
-        for i in range(6):
-            base_angle = math.radians(60 * i)
-            delta = random.uniform(-angle_noise, angle_noise)
-            obj.rotation_euler.z = base_angle + delta
-
-            # 更新相机位置节点（位置不变，可选执行）
-            mat = obj.data.materials[0]
-            nodes = mat.node_tree.nodes
-            for name, val in [('CamX', cam.location.x), ('CamY', cam.location.y), ('CamZ', cam.location.z)]:
-                if name in nodes:
-                    nodes[name].outputs[0].default_value = val
-
-            # 烘焙并保存
-            img = create_bake_image(RESOLUTION)
-            attach_texture_node(obj, img, cam)
-            bake_to_image(obj, cam, PADDING)
-            out_img = OUTPUT_IMAGE.replace('.png', f'_{vid}_{i}.png')
-            out_blend = OUTPUT_BLEND.replace('.blend', f'_{vid}_{i}.blend')
-            save_image(img, out_img)
-            save_blend(out_blend)
-            print(f"[Shot {shot}] CameraIdx: {vid}, ObjRot: {obj.rotation_euler}")
-            shot += 1
 
+def main():
+    argv = sys.argv
+    user_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    parser = argparse.ArgumentParser(description="Multi-view bake")
+    parser.add_argument('--num_shards', type=int, default=NUM_SHARDS, help='并行的 Blender 子进程数（1 为单进程）')
+    parser.add_argument('--seed',       type=int, default=SEED,       help='物体旋转抖动的随机种子')
+    parser.add_argument('--shard',      type=int, default=None,       help='（内部）本进程负责的分片序号')
+    parser.add_argument('--profile',    action='store_true', help='用 cProfile 剖析烘焙（分片时每个子进程各写一份）')
+    args = parser.parse_args(user_args)
+
+    shots = shot_grid(args.seed)
+    if args.profile and (args.shard is not None or args.num_shards <= 1):
+        suffix = f'_profile_shard{args.shard}' if args.shard is not None else '_profile'
+        PipelineProfiler(os.path.splitext(OUTPUT_IMAGE)[0] + suffix).start()
+    if args.shard is not None:
+        # 子进程：只烘焙自己的分片，记录写入分片清单
+        records = run_shots(shots[args.shard::args.num_shards])
+        with open(OUTPUT_IMAGE.replace('.png', f'_shard{args.shard}.json'), 'w', encoding='utf-8') as f:
+            json.dump(records, f, ensure_ascii=False, indent=2)
+    elif args.num_shards > 1:
+        run_sharded(args.num_shards, args.seed, args.profile)
+    else:
+        run_shots(shots)
     print("All shots completed.")
 
 
@@ -2,10 +2,29 @@
 # -*- coding: utf-8 -*-
 
 import os
+import csv
+import json
+import time
+import struct
 import subprocess
+import tempfile
 import logging
+import argparse
+from collections import deque
 from tqdm import tqdm
 
+from shard_archive import ShardWriter
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
 # ─── 配置 ────────────────────────────────────────────────────────────────
 # A 文件夹路径（存放待烘培的 .glb）
 INPUT_DIR = r"F:\AI\datasets\objaverse_result\batch_1_filter_glbs"
@@ -20,6 +39,32 @@ BAKE_SCRIPT = os.path.join(SCRIPT_DIR, "bake_glb.py")
 LOG_FILE = os.path.join(SCRIPT_DIR, "bake_glb.log")
 # 断点续传状态文件
 STATE_FILE = os.path.join(SCRIPT_DIR, "bake_state.txt")
+# 烘焙分辨率（传给 bake_glb.py，同时用于内存预测）
+BAKE_RESOLUTION = 2048
+# 并发烘焙的内存预算（GB），按预测峰值内存准入
+RAM_BUDGET_GB = 112
+# 最大并发 Blender 进程数
+MAX_WORKERS = 8
+# 轮询子进程状态 / 采样峰值内存的间隔（秒）
+POLL_INTERVAL = 0.5
+# 每个任务的峰值内存记录，用于拟合内存预测模型（跨运行复用）
+MEM_STATS_FILE = os.path.join(SCRIPT_DIR, "bake_mem_stats.csv")
+# 守护模式：已处理文件清单（每行一个文件名）与状态文件
+DAEMON_STATE_FILE = os.path.join(SCRIPT_DIR, "bake_daemon_done.txt")
+STATUS_FILE = os.path.join(SCRIPT_DIR, "bake_status.json")
+# 新文件大小和 mtime 连续不变多久（秒）才视为写完
+STABLE_SECONDS = 2.0
+# 目录全量扫描间隔（秒）：无 inotify 时的轮询周期，有 inotify 时用于兜底漏掉的事件
+RESCAN_INTERVAL = 30.0
+# 分片归档输出：开启后烘焙结果写入 <ARCHIVE_DIR>/baked-*.tar 分片（附 .idx 索引），不保留零散 GLB
+ARCHIVE_OUTPUT = False
+ARCHIVE_DIR = OUTPUT_DIR
+ARCHIVE_MAX_GB = 4
+# 吞吐量统计窗口（最近完成的任务数）
+THROUGHPUT_WINDOW = 50
+# 慢任务自动剖析：每个任务都带 cProfile 运行，总耗时超过该秒数时把 .pstats / .collapsed 写入 PROFILE_DIR（None 关闭）
+PROFILE_SLOW_JOBS_S = None
+PROFILE_DIR = os.path.join(SCRIPT_DIR, "profiles")
 # ─────────────────────────────────────────────────────────────────────────────
 
 def setup_logging():
@@ -50,8 +95,142 @@ def write_current_index(idx):
     except Exception:
         logging.exception("写入状态文件失败: %s", STATE_FILE)
 
-def bake_file(glb_path):
-    """调用 Blender 执行烘培脚本，返回 (success: bool, returncode: int, stderr: str)"""
+def read_image_size(head):
+    """从 PNG / JPEG 文件头解析宽高，无法识别时返回 None"""
+    if head.startswith(b'\x89PNG') and len(head) >= 24:
+        return struct.unpack('>II', head[16:24])
+    if head.startswith(b'\xff\xd8'):
+        i = 2
+        while i + 9 < len(head):
+            if head[i] != 0xFF:
+                i += 1
+                continue
+            marker = head[i + 1]
+            seg_len = struct.unpack('>H', head[i + 2:i + 4])[0]
+            # SOF0–SOF15（排除 DHT / JPG / DAC）
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                h, w = struct.unpack('>HH', head[i + 5:i + 9])
+                return w, h
+            i += 2 + seg_len
+    return None
+
+def glb_features(glb_path):
+    """只读 GLB 的 JSON chunk 和图像文件头，返回 (三角形数, 源贴图像素数)"""
+    with open(glb_path, 'rb') as f:
+        magic, _, _ = struct.unpack('<4sII', f.read(12))
+        if magic != b'glTF':
+            raise ValueError("Not a valid GLB file")
+        json_length, json_type = struct.unpack('<I4s', f.read(8))
+        if json_type != b'JSON':
+            raise ValueError("Missing JSON chunk in GLB")
+        gltf = json.loads(f.read(json_length).decode('utf-8'))
+        bin_start = 12 + 8 + json_length + 8
+
+        accessors = gltf.get('accessors', [])
+        tris = 0
+        for mesh in gltf.get('meshes', []):
+            for prim in mesh.get('primitives', []):
+                if 'indices' in prim:
+                    tris += accessors[prim['indices']]['count'] // 3
+                elif 'POSITION' in prim.get('attributes', {}):
+                    tris += accessors[prim['attributes']['POSITION']]['count'] // 3
+
+        pixels = 0
+        for img in gltf.get('images', []):
+            if 'bufferView' not in img:
+                continue
+            bv = gltf['bufferViews'][img['bufferView']]
+            f.seek(bin_start + bv.get('byteOffset', 0))
+            size = read_image_size(f.read(min(bv['byteLength'], 64 * 1024)))
+            if size:
+                pixels += size[0] * size[1]
+    return tris, pixels
+
+class MemoryModel:
+    """峰值内存（MB）≈ 线性组合(常数, 百万三角形, 源贴图百万像素, 烘焙图百万像素)，岭回归在线拟合。
+    只保存 XᵀX、Xᵀy 的累计和：启动时读一遍 CSV，之后每个样本 O(1) 更新，拟合只解 4×4 方程"""
+
+    # 样本不足时的保守先验：基础开销、每百万三角形、每百万源像素（float RGBA）、每百万烘焙像素（3 张图 + Cycles 缓冲）
+    PRIOR = [1500.0, 600.0, 20.0, 120.0]
+    MIN_SAMPLES = 8
+    SAFETY = 1.2
+
+    def __init__(self, path):
+        self.path = path
+        n = len(self.PRIOR)
+        self.count = 0
+        self.xtx = [[0.0] * n for _ in range(n)]
+        self.xty = [0.0] * n
+        self.coef = list(self.PRIOR)
+        if os.path.exists(path):
+            with open(path, newline='') as f:
+                for row in csv.reader(f):
+                    try:
+                        x, y = [float(v) for v in row[1:5]], float(row[5])
+                    except (ValueError, IndexError):
+                        continue
+                    self.accumulate(x, y)
+            self.fit()
+
+    @staticmethod
+    def features(tris, pixels):
+        return [1.0, tris / 1e6, pixels / 1e6, BAKE_RESOLUTION * BAKE_RESOLUTION / 1e6]
+
+    def predict(self, x):
+        return max(self.PRIOR[0], sum(c * v for c, v in zip(self.coef, x)) * self.SAFETY)
+
+    def accumulate(self, x, y):
+        self.count += 1
+        for i in range(len(x)):
+            for j in range(len(x)):
+                self.xtx[i][j] += x[i] * x[j]
+            self.xty[i] += x[i] * y
+
+    def add(self, name, x, peak_mb):
+        self.accumulate(x, peak_mb)
+        with open(self.path, 'a', newline='') as f:
+            csv.writer(f).writerow([name] + x + [peak_mb])
+        self.fit()
+
+    def fit(self):
+        if self.count < self.MIN_SAMPLES:
+            return
+        n = len(self.PRIOR)
+        # 正规方程 (XᵀX + λI) c = Xᵀy + λ·先验，λ 把系数往先验拉
+        lam = 1e-3 * self.count
+        a = [[self.xtx[i][j] + (lam if i == j else 0.0) for j in range(n)] + [self.xty[i] + lam * self.PRIOR[i]]
+             for i in range(n)]
+        for col in range(n):
+            piv = max(range(col, n), key=lambda r: abs(a[r][col]))
+            if abs(a[piv][col]) < 1e-12:
+                return
+            a[col], a[piv] = a[piv], a[col]
+            for r in range(n):
+                if r != col:
+                    k = a[r][col] / a[col][col]
+                    for c in range(col, n + 1):
+                        a[r][c] -= k * a[col][c]
+        self.coef = [a[i][n] / a[i][i] for i in range(n)]
+
+def read_peak_rss_mb(pid):
+    """读取子进程的峰值 RSS（MB），不可用时返回 None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if psutil is not None:
+        try:
+            mi = psutil.Process(pid).memory_info()
+            return getattr(mi, 'peak_wset', mi.rss) / (1 << 20)
+        except psutil.Error:
+            pass
+    return None
+
+def start_bake(glb_path):
+    """启动 Blender 执行烘培脚本，返回 (Popen, stderr 临时文件, 输出路径)"""
     name_no_ext = os.path.splitext(os.path.basename(glb_path))[0]
     output_glb = os.path.join(OUTPUT_DIR, f"{name_no_ext}_baked.glb")
 
@@ -62,15 +241,85 @@ def bake_file(glb_path):
         "--",  # 分隔 Blender 参数和脚本参数
         "--disable_export_debug",
         "--input_file", glb_path,
-        "--output_file", output_glb
+        "--output_file", output_glb,
+        "--bake_resolution", str(BAKE_RESOLUTION)
     ]
+    if PROFILE_SLOW_JOBS_S is not None:
+        cmd += ["--profile_threshold", str(PROFILE_SLOW_JOBS_S), "--profile_dir", PROFILE_DIR]
+
+    # stderr 写临时文件而不是管道，避免并发时管道写满阻塞子进程
+    err = tempfile.TemporaryFile(mode='w+')
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=err, text=True)
+    return proc, err, output_glb
+
+def admit(pending, running, model, budget_mb):
+    """按顺序取队首准入：只有预测总内存不超预算时才启动（没有任务在跑时总是启动）。
+    pending 中为 (key, fname)，返回启动失败的 key 列表"""
+    failed = []
+    while pending and len(running) < MAX_WORKERS:
+        key, fname = pending[0]
+        full_input = os.path.join(INPUT_DIR, fname)
+        try:
+            x = model.features(*glb_features(full_input))
+        except Exception:
+            logging.exception("读取 GLB 元数据失败：%s", fname)
+            x = None
+        pred = model.predict(x) if x else max(model.PRIOR[0], max((j['pred'] for j in running), default=0))
+        committed = sum(max(j['pred'], j['peak']) for j in running)
+        if running and committed + pred > budget_mb:
+            break
+        pending.popleft()
+        try:
+            proc, err, output = start_bake(full_input)
+        except Exception as e:
+            logging.exception("💥 崩溃：%s 异常信息：%s", fname, e)
+            failed.append(key)
+            continue
+        running.append({'key': key, 'fname': fname, 'proc': proc, 'err': err, 'output': output,
+                        'x': x, 'pred': pred, 'peak': 0.0})
+    return failed
 
-    proc = subprocess.run(cmd, capture_output=True, text=True)
-    return proc.returncode == 0, proc.returncode, proc.stderr
+def reap(running, model, archive=None):
+    """采样峰值内存并回收已结束的子进程，返回 [(key, success)]。
+    archive 为 ShardWriter 时，把输出 GLB 移入分片"""
+    finished = []
+    for job in list(running):
+        peak = read_peak_rss_mb(job['proc'].pid)
+        if peak is not None:
+            job['peak'] = max(job['peak'], peak)
+        code = job['proc'].poll()
+        if code is None:
+            continue
+        running.remove(job)
+        job['err'].seek(0)
+        stderr = job['err'].read()
+        job['err'].close()
+        if code != 0:
+            logging.error("❌ 失败：%s 退出码=%d\n%s", job['fname'], code, stderr.strip())
+        else:
+            if job['x'] and job['peak'] > 0:
+                model.add(job['fname'], job['x'], job['peak'])
+            if archive is not None and os.path.exists(job['output']):
+                try:
+                    archive.add_file(os.path.basename(job['output']), job['output'])
+                    os.remove(job['output'])
+                except Exception:
+                    logging.exception("写入分片失败：%s", job['output'])
+        finished.append((job['key'], code == 0))
+    return finished
+
+def committed_gb(running):
+    return sum(max(j['pred'], j['peak']) for j in running) / 1024
+
+def open_archive():
+    if not ARCHIVE_OUTPUT:
+        return None
+    return ShardWriter(ARCHIVE_DIR, "baked", max_bytes=int(ARCHIVE_MAX_GB * (1 << 30)))
 
 def main():
     setup_logging()
     os.makedirs(OUTPUT_DIR, exist_ok=True)
+    archive = open_archive()
 
     # 收集并排序所有 .glb 文件
     files = sorted([f for f in os.listdir(INPUT_DIR) if f.lower().endswith('.glb')])
@@ -79,23 +328,184 @@ def main():
     # 读取上次中断索引
     start_idx = read_start_index()
 
+    model = MemoryModel(MEM_STATS_FILE)
+    budget_mb = RAM_BUDGET_GB * 1024
+    pending = deque((idx, files[idx]) for idx in range(start_idx, total))
+    running = []
+    done = set()
+    next_unfinished = start_idx
+
     # 使用 tqdm 进度条并显示 ETA
     pbar = tqdm(total=total, initial=start_idx, desc="烘焙进度", unit="file")
-    for idx, fname in enumerate(files):
-        if idx < start_idx:
-            continue
-        full_input = os.path.join(INPUT_DIR, fname)
-        try:
-            success, code, stderr = bake_file(full_input)
-            if not success:
-                logging.error("❌ 失败：%s 退出码=%d\n%s", fname, code, stderr.strip())
-        except Exception as e:
-            logging.exception("💥 崩溃：%s 异常信息：%s", fname, e)
-        finally:
-            # 更新状态文件
-            write_current_index(idx + 1)
+    while pending or running:
+        for idx in admit(pending, running, model, budget_mb):
+            done.add(idx)
+            pbar.update(1)
+
+        time.sleep(POLL_INTERVAL)
+
+        for idx, _ in reap(running, model, archive):
+            done.add(idx)
             pbar.update(1)
+
+        # 更新状态文件：只记录全部完成的连续前缀，乱序完成时断点续传不会漏文件
+        if next_unfinished in done:
+            while next_unfinished in done:
+                done.discard(next_unfinished)
+                next_unfinished += 1
+            write_current_index(next_unfinished)
+        pbar.set_postfix(jobs=len(running), mem_gb=f"{committed_gb(running):.1f}")
     pbar.close()
+    if archive is not None:
+        archive.close()
+
+# ─── 守护模式 ────────────────────────────────────────────────────────────────
+
+class InputWatcher:
+    """监视 INPUT_DIR 中新出现的 .glb（有 inotify_simple 时用 inotify，否则轮询），
+    文件大小和 mtime 连续 STABLE_SECONDS 不变才视为写完。
+    失败的文件记下当时的 (size, mtime)，文件再次变化（例如拷贝完成或被替换）后重新入队"""
+
+    def __init__(self, directory, seen):
+        self.directory = directory
+        self.seen = set(seen)
+        self.candidates = {}      # fname -> (size, mtime, 稳定起始时间)
+        self.queued = {}          # fname -> 入队时的 (size, mtime)
+        self.failed = {}          # fname -> 失败任务读到的 (size, mtime)
+        self.last_scan = 0.0
+        self.inotify = None
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                self.inotify.add_watch(directory, inotify_flags.CREATE | inotify_flags.MODIFY |
+                                       inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+            except OSError:
+                logging.exception("inotify 不可用，改用轮询：%s", directory)
+                self.inotify = None
+
+    def wait(self, timeout):
+        """等待最多 timeout 秒，返回已写完的新文件名（按名称排序）"""
+        if self.inotify is not None:
+            for event in self.inotify.read(timeout=int(timeout * 1000)):
+                self._add(event.name)
+        else:
+            time.sleep(timeout)
+        now = time.time()
+        if self.inotify is None or now - self.last_scan >= RESCAN_INTERVAL:
+            self.last_scan = now
+            for fname in os.listdir(self.directory):
+                self._add(fname)
+        return self._stable(now)
+
+    def finish(self, fname, success):
+        """任务结束：失败的文件移出 seen，记下入队时的 (size, mtime)，之后文件变化才重新入队"""
+        signature = self.queued.pop(fname, None)
+        if success:
+            return
+        self.seen.discard(fname)
+        if signature is not None:
+            self.failed[fname] = signature
+
+    def _add(self, fname):
+        if not fname.lower().endswith('.glb') or fname in self.seen or fname in self.candidates:
+            return
+        if fname in self.failed:
+            try:
+                st = os.stat(os.path.join(self.directory, fname))
+            except OSError:
+                return
+            if (st.st_size, st.st_mtime) == self.failed[fname]:
+                return
+            del self.failed[fname]
+        self.candidates[fname] = (None, None, 0.0)
+
+    def _stable(self, now):
+        ready = []
+        for fname, (size, mtime, since) in list(self.candidates.items()):
+            try:
+                st = os.stat(os.path.join(self.directory, fname))
+            except OSError:
+                del self.candidates[fname]
+                continue
+            if (st.st_size, st.st_mtime) != (size, mtime):
+                self.candidates[fname] = (st.st_size, st.st_mtime, now)
+            elif now - since >= STABLE_SECONDS:
+                del self.candidates[fname]
+                self.seen.add(fname)
+                self.queued[fname] = (size, mtime)
+                ready.append(fname)
+        return sorted(ready)
+
+def write_status(pending, running, completed, failed, finish_times, started):
+    """把队列深度、吞吐量和 ETA 写入 STATUS_FILE（先写临时文件再替换）"""
+    window = list(finish_times)
+    throughput = 0.0
+    if len(window) >= 2 and window[-1] > window[0]:
+        throughput = (len(window) - 1) / (window[-1] - window[0]) * 3600
+    remaining = len(pending) + len(running)
+    status = {
+        'updated': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'uptime_s': round(time.time() - started),
+        'queue_depth': len(pending),
+        'running': [j['fname'] for j in running],
+        'completed': completed,
+        'failed': failed,
+        'throughput_per_hour': round(throughput, 1),
+        'eta_s': round(remaining / throughput * 3600) if throughput > 0 else None,
+        'committed_mem_gb': round(committed_gb(running), 1),
+    }
+    tmp_path = STATUS_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(status, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, STATUS_FILE)
+
+def daemon_main():
+    """守护模式：持续监视 INPUT_DIR，新文件写完后立即进入烘焙队列"""
+    setup_logging()
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    processed = set()
+    if os.path.exists(DAEMON_STATE_FILE):
+        with open(DAEMON_STATE_FILE, 'r', encoding='utf-8') as f:
+            processed = {line.strip() for line in f if line.strip()}
+
+    model = MemoryModel(MEM_STATS_FILE)
+    budget_mb = RAM_BUDGET_GB * 1024
+    archive = open_archive()
+    watcher = InputWatcher(INPUT_DIR, processed)
+    pending = deque()
+    running = []
+    completed = failed = 0
+    finish_times = deque(maxlen=THROUGHPUT_WINDOW)
+    started = time.time()
+
+    def record(fname, success):
+        """只有成功的文件写入已处理清单；失败的交给 watcher，文件变化后重试"""
+        nonlocal completed, failed
+        completed += 1
+        failed += 0 if success else 1
+        finish_times.append(time.time())
+        watcher.finish(fname, success)
+        if not success:
+            return
+        with open(DAEMON_STATE_FILE, 'a', encoding='utf-8') as f:
+            f.write(fname + "\n")
+
+    # 启动时已有的文件同样经过 watcher 的稳定性检查（首次 wait 即全量扫描），
+    # 避免把启动时仍在拷贝的文件烘焙成半截
+    while True:
+        for fname in admit(pending, running, model, budget_mb):
+            record(fname, False)
+        for fname in watcher.wait(POLL_INTERVAL):
+            pending.append((fname, fname))
+        for fname, success in reap(running, model, archive):
+            record(fname, success)
+        write_status(pending, running, completed, failed, finish_times, started)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="批量烘焙 INPUT_DIR 中的 .glb")
+    parser.add_argument('--daemon', action='store_true', help='守护模式：持续监视 INPUT_DIR 并处理新到达的文件')
+    if parser.parse_args().daemon:
+        daemon_main()
+    else:
+        main()
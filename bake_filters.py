@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# bake_filters.py
+#
+# bake_glb.py / advanced_bake.py 共用的 NumPy 图像与 UV 工具，不依赖 bpy
+import numpy as np
+
+
+def read_uv_triangles(me, uv_name):
+    """按 loop 三角形读取 UV：(n, 3, 2)"""
+    me.calc_loop_triangles()
+    n = len(me.loop_triangles)
+    tri_loops = np.empty(n * 3, dtype=np.int32)
+    me.loop_triangles.foreach_get('loops', tri_loops)
+    uv = np.empty(len(me.loops) * 2, dtype=np.float32)
+    me.uv_layers[uv_name].data.foreach_get('uv', uv)
+    return uv.reshape(-1, 2)[tri_loops].reshape(n, 3, 2)
+
+
+def read_co_triangles(me):
+    """按 loop 三角形读取顶点坐标（网格局部空间）：(n, 3, 3)，顺序与 read_uv_triangles 一致"""
+    me.calc_loop_triangles()
+    n = len(me.loop_triangles)
+    tri_verts = np.empty(n * 3, dtype=np.int32)
+    me.loop_triangles.foreach_get('vertices', tri_verts)
+    co = np.empty(len(me.vertices) * 3, dtype=np.float32)
+    me.vertices.foreach_get('co', co)
+    return co.reshape(-1, 3)[tri_verts].reshape(n, 3, 3)
+
+
+def rasterize_uv_coverage(tri_uv, res_x, res_y, chunk=1 << 23):
+    """在 res_x×res_y 像素中心上光栅化 UV 三角形，返回每个像素被覆盖的次数 (res_y, res_x)"""
+    coverage = np.zeros(res_x * res_y, dtype=np.int32)
+    if len(tri_uv) == 0:
+        return coverage.reshape(res_y, res_x)
+    a, b, c = tri_uv[:, 0], tri_uv[:, 1], tri_uv[:, 2]
+    area = (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0])
+    keep = np.abs(area) > 1e-12   # 退化三角形不参与
+    # 像素坐标平移半个像素，使像素中心落在整数格点上
+    res = np.array([res_x, res_y], dtype=np.float32)
+    t = tri_uv[keep] * res - 0.5
+    sign = np.sign(area[keep])
+    lo = np.clip(np.ceil(t.min(axis=1)), 0, res - 1).astype(np.int64)
+    hi = np.clip(np.floor(t.max(axis=1)), 0, res - 1).astype(np.int64)
+    bw = np.maximum(hi[:, 0] - lo[:, 0] + 1, 0)
+    bh = np.maximum(hi[:, 1] - lo[:, 1] + 1, 0)
+    counts = bw * bh
+
+    ends = np.cumsum(counts)
+    start_tri = 0
+    while start_tri < len(t):
+        # 每批候选像素不超过 chunk 个
+        base = ends[start_tri - 1] if start_tri else 0
+        stop_tri = max(int(np.searchsorted(ends, base + chunk, side='right')), start_tri + 1)
+        cnt = counts[start_tri:stop_tri]
+        tri = np.repeat(np.arange(start_tri, stop_tri), cnt)
+        local = np.arange(int(cnt.sum())) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+        px = lo[tri, 0] + local % bw[tri]
+        py = lo[tri, 1] + local // bw[tri]
+        p = np.stack([px, py], axis=1).astype(np.float32)
+        inside = np.ones(len(tri), dtype=bool)
+        for k in range(3):
+            e0 = t[tri, k]
+            e1 = t[tri, (k + 1) % 3]
+            w = (e1[:, 0] - e0[:, 0]) * (p[:, 1] - e0[:, 1]) - (e1[:, 1] - e0[:, 1]) * (p[:, 0] - e0[:, 0])
+            inside &= w * sign[tri] > 0
+        coverage += np.bincount(py[inside] * res_x + px[inside], minlength=res_x * res_y).astype(np.int32)
+        start_tri = stop_tri
+    return coverage.reshape(res_y, res_x)
+
+
+def filter_taps(k, method, a=3):
+    """整数倍 k 降采样的一维滤波抽头：(相对 i*k 的偏移, 权重)"""
+    if method == 'box':
+        return np.arange(k), np.full(k, 1.0 / k, dtype=np.float32)
+    # Lanczos-a：输出像素中心 (i+0.5)*k，输入像素中心 j+0.5
+    offsets = np.arange(int(np.floor(0.5 * k - a * k)), int(np.ceil(0.5 * k + a * k)) + 1)
+    d = (offsets + 0.5 - 0.5 * k) / k
+    w = np.where(np.abs(d) < a, np.sinc(d) * np.sinc(d / a), 0.0)
+    return offsets, (w / w.sum()).astype(np.float32)
+
+
+def filter_axis(arr, k, offsets, weights, axis):
+    """沿 axis 做整数倍 k 的可分离滤波降采样，越界按边缘像素处理"""
+    n_in = arr.shape[axis]
+    base = np.arange(n_in // k) * k
+    out = None
+    for m, w in zip(offsets, weights):
+        if w == 0.0:
+            continue
+        term = w * np.take(arr, np.clip(base + m, 0, n_in - 1), axis=axis)
+        out = term if out is None else out + term
+    return out
+
+
+def downsample_masked(pixels, mask, k, method='lanczos'):
+    """pixels (H, W, C) 按岛屿掩码 mask (H, W) 降采样 k 倍：
+    岛屿内像素只用掩码内的样本加权，避免 margin 扩边和相邻岛屿的颜色渗入；
+    岛屿外像素（margin 区）用普通滤波结果。返回 (out, 降采样后的覆盖率)
+    Lanczos 有负瓣，岛屿边缘的掩码权重和会正负相消接近 0，归一化后放大到饱和，
+    所以只对完全覆盖的像素用带掩码的 Lanczos，部分覆盖的边缘像素用掩码内的盒式平均"""
+    offsets, weights = filter_taps(k, method)
+    box_offsets, box_weights = filter_taps(k, 'box')
+    m = mask.astype(np.float32)[..., None]
+
+    def resample(arr, offsets=offsets, weights=weights):
+        return filter_axis(filter_axis(arr, k, offsets, weights, axis=1), k, offsets, weights, axis=0)
+
+    pm = pixels * m
+    num = resample(pm)
+    den = resample(m)
+    plain = resample(pixels)
+    coverage = resample(m, box_offsets, box_weights)
+    box_mean = resample(pm, box_offsets, box_weights) / np.maximum(coverage, 1e-6)
+    stable = (coverage >= 1.0 - 1e-6) & (den > 0.5)
+    out = np.where(coverage > 0, np.where(stable, num / np.where(stable, den, 1.0), box_mean), plain)
+    return np.clip(out, 0.0, 1.0).astype(np.float32), coverage[..., 0]
+
+
+def mip_pyramid(pixels, coverage, min_size=1):
+    """用带掩码的 2× 盒式滤波生成 mip 链（不含第 0 级）"""
+    levels = []
+    while min(pixels.shape[:2]) // 2 >= min_size and min(pixels.shape[:2]) >= 2:
+        h, w = pixels.shape[0] // 2 * 2, pixels.shape[1] // 2 * 2
+        pixels, coverage = downsample_masked(pixels[:h, :w], coverage[:h, :w] > 0, 2, 'box')
+        levels.append(pixels)
+    return levels
+
+
+def estimate_noise(pixels, mask=None):
+    """Immerkær 快速噪声估计：亮度上的 3×3 拉普拉斯差分的平均绝对值，
+    只统计 3×3 邻域全部落在 mask 内的像素，返回噪声标准差 σ"""
+    lum = pixels[..., 0] * 0.2126 + pixels[..., 1] * 0.7152 + pixels[..., 2] * 0.0722
+    h, w = lum.shape
+    if h < 3 or w < 3:
+        return 0.0
+    conv = np.zeros((h - 2, w - 2), dtype=np.float32)
+    kernel = ((1, -2, 1), (-2, 4, -2), (1, -2, 1))
+    valid = np.ones((h - 2, w - 2), dtype=bool)
+    for dy in range(3):
+        for dx in range(3):
+            conv += kernel[dy][dx] * lum[dy:dy + h - 2, dx:dx + w - 2]
+            if mask is not None:
+                valid &= mask[dy:dy + h - 2, dx:dx + w - 2]
+    if not valid.any():
+        return 0.0
+    return float(np.sqrt(np.pi / 2.0) * np.abs(conv[valid]).mean() / 6.0)
+
+
+def linear_to_srgb(x):
+    """线性值编码为 sRGB（IEC 61966-2-1），输入输出均在 [0, 1]"""
+    x = np.clip(x, 0.0, 1.0)
+    return np.where(x <= 0.0031308, x * 12.92, 1.055 * np.power(x, 1.0 / 2.4) - 0.055).astype(np.float32)
+
+
+def srgb_to_linear(x):
+    """sRGB 编码值解码为线性值"""
+    x = np.clip(x, 0.0, 1.0)
+    return np.where(x <= 0.04045, x / 12.92, np.power((x + 0.055) / 1.055, 2.4)).astype(np.float32)
@@ -1,9 +1,17 @@
 import bpy
 import sys
 import os
+import time
+import hashlib
+import numpy as np
 from mathutils import Vector
 import argparse
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bake_filters import (read_uv_triangles, read_co_triangles, rasterize_uv_coverage,
+                          downsample_masked, mip_pyramid, linear_to_srgb, srgb_to_linear)
+from bake_profile import PipelineProfiler
+
 # ─── Configuration ───────────────────────────────────────────────────────────────
 # Replace these paths with your actual input/output files:
 INPUT_FILE  = r"F:\AI\datasets\objaverse_result\xatlas_py\000a883519934f4383b9aeb0d535c545.glb"
@@ -17,6 +25,10 @@ MRBAKE_IMAGE_NAME = "MetallicRoughnessBake"
 BAKE_IMAGE_NAME       = "BakedTexture"
 NORMALBAKE_IMAGE_NAME = "NormalBake"
 FINAL_MAT_NAME  = "BakedMaterial"
+STAGE_CACHE_DIR = None  # 阶段检查点目录；None 表示关闭（参数扫描时再用 --stage_cache_dir 打开）
+TEXTURE_CACHE_DIR = None  # 预采样贴图缓存目录；None 表示不缓存（多个资产共用贴图时再用 --texture_cache_dir 打开）
+TEXTURE_RESAMPLE_SAFETY = 2.0   # 源贴图相对烘焙所需纹素密度的保留倍数（Nyquist 余量）
+TEXTURE_MIN_SIZE = 64           # 预采样后的最小边长
 # ────────────────────────────────────────────────────────────────────────────────
 
 
@@ -43,6 +55,25 @@ parser.add_argument('--bake_image_name',        default=BAKE_IMAGE_NAME,
 parser.add_argument('--normalbake_image_name',  default=NORMALBAKE_IMAGE_NAME,   help='法线 烘焙图名称')
 parser.add_argument('--final_mat_name',         default=FINAL_MAT_NAME,          help='最终材质名称')
 parser.add_argument('--disable_export_debug', action='store_true', help='Disable final GLB export and .blend save')
+parser.add_argument('--disable_texture_resample', action='store_true', help='关闭烘焙前的源贴图预采样')
+parser.add_argument('--join_backend',           default='array', choices=['array', 'ops'],
+                    help='网格合并方式：array（foreach_get + NumPy 一次性构建）或 ops（bpy.ops.object.join）')
+parser.add_argument('--uv_backend',             default='blender', choices=['blender', 'xatlas', 'reuse', 'auto'],
+                    help='UV 展开后端：blender（smart_project + pack_islands）、xatlas（多线程分块/打包）、'
+                         'reuse（沿用无重叠且在 [0,1] 内的原始 UVMap）、auto（reuse → xatlas → blender）')
+parser.add_argument('--bake_tile_size',         type=int,    default=0,           help='分块烘焙的块大小（像素），限制 Cycles 烘焙缓冲的大小（拼接缓冲仍与分辨率成正比），0 表示整图一次烘焙')
+parser.add_argument('--supersample',            type=int,    default=1,           help='EMIT 通道超采样倍数：1 采样在 k 倍分辨率烘焙后降采样（1 表示关闭）')
+parser.add_argument('--ss_filter',              default='lanczos', choices=['box', 'lanczos'], help='超采样降采样滤波器')
+parser.add_argument('--export_mips',            action='store_true', help='为烘焙图生成 mip 链并保存到输出 GLB 旁')
+parser.add_argument('--stage_cache_dir',        default=STAGE_CACHE_DIR,         help='开启阶段检查点并写入该目录（合并网格 / BakedUV），改分辨率或边距重烘时跳过导入、合并和展开；'
+                                                                                         '检查点含打包的源贴图且不会自动清理，扫描结束后直接删除该目录')
+parser.add_argument('--optimize_glb',           action='store_true', help='导出后焊接顶点、重排索引并紧凑重写 BIN（optimize_glb.py）')
+parser.add_argument('--quantize',               action='store_true', help='配合 --optimize_glb 使用 KHR_mesh_quantization 量化顶点属性')
+parser.add_argument('--texture_cache_dir',      default=TEXTURE_CACHE_DIR,       help='开启预采样贴图缓存并写入该目录（按图像哈希跨任务复用，字节图存 uint8）；'
+                                                                                         '不会自动清理，用完直接删除该目录')
+parser.add_argument('--profile',                action='store_true', help='用 cProfile 剖析整条流水线，写出 .pstats 与 flamegraph 用的 .collapsed')
+parser.add_argument('--profile_threshold',      type=float,  default=None,        help='剖析但只在总耗时不少于该秒数时写文件（批处理抓慢任务用）')
+parser.add_argument('--profile_dir',            default=None,                    help='剖析结果目录（默认与输出 GLB 同目录）')
 args = parser.parse_args(user_args)
 
 # 覆盖默认配置
@@ -57,6 +88,666 @@ MRBAKE_IMAGE_NAME      = args.mr_bake_image_name
 BAKE_IMAGE_NAME        = args.bake_image_name
 NORMALBAKE_IMAGE_NAME  = args.normalbake_image_name
 FINAL_MAT_NAME         = args.final_mat_name
+TEXTURE_CACHE_DIR      = args.texture_cache_dir
+STAGE_CACHE_DIR        = args.stage_cache_dir
+STAGE_CACHE            = STAGE_CACHE_DIR is not None
+
+if args.profile or args.profile_threshold is not None:
+    # 从这里开始剖析；解释器退出时写出结果（中途 sys.exit 的任务也有）
+    profile_base = os.path.splitext(OUTPUT_FILE)[0] + "_profile"
+    if args.profile_dir:
+        profile_base = os.path.join(args.profile_dir, os.path.basename(profile_base))
+    PipelineProfiler(profile_base, threshold=None if args.profile else args.profile_threshold).start()
+# ────────────────────────────────────────────────────────────────────────────────
+
+# ─── 源贴图预采样 ────────────────────────────────────────────────────────────────
+# 导入的 GLB 常带 4K–8K 源贴图，而烘焙目标只有 BAKE_RESOLUTION。
+# 按每张图实际需要的纹素密度把过大的源图降采样，减少 Cycles 的图像内存。
+# sRGB 字节图在线性空间里求平均。缓存默认关闭：只有贴图在资产间共用时才会命中，
+# 逐资产写入会让缓存目录随数据集线性增长且不会自动淘汰。
+
+def material_surface_stats(meshes):
+    """统计每个材质的世界空间表面积和在原始 UV 中的覆盖面积：{name: (area3d, area_uv)}"""
+    stats = {}
+    for obj in meshes:
+        me = obj.data
+        me.calc_loop_triangles()
+        n = len(me.loop_triangles)
+        if n == 0:
+            continue
+        tri_verts = np.empty(n * 3, dtype=np.int32)
+        tri_loops = np.empty(n * 3, dtype=np.int32)
+        mat_idx = np.empty(n, dtype=np.int32)
+        me.loop_triangles.foreach_get('vertices', tri_verts)
+        me.loop_triangles.foreach_get('loops', tri_loops)
+        me.loop_triangles.foreach_get('material_index', mat_idx)
+
+        co = np.empty(len(me.vertices) * 3, dtype=np.float32)
+        me.vertices.foreach_get('co', co)
+        mw = np.array(obj.matrix_world, dtype=np.float32)
+        co = co.reshape(-1, 3) @ mw[:3, :3].T + mw[:3, 3]
+        p = co[tri_verts].reshape(n, 3, 3)
+        area3d = 0.5 * np.linalg.norm(np.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0]), axis=1)
+
+        uv = np.zeros(len(me.loops) * 2, dtype=np.float32)
+        if len(me.uv_layers) > 0:
+            me.uv_layers[0].data.foreach_get('uv', uv)
+        t = uv.reshape(-1, 2)[tri_loops].reshape(n, 3, 2)
+        e1 = t[:, 1] - t[:, 0]
+        e2 = t[:, 2] - t[:, 0]
+        area_uv = 0.5 * np.abs(e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0])
+
+        for slot_idx, slot in enumerate(obj.material_slots):
+            if slot.material is None:
+                continue
+            sel = mat_idx == slot_idx
+            a3, auv = stats.get(slot.material.name, (0.0, 0.0))
+            stats[slot.material.name] = (a3 + float(area3d[sel].sum()), auv + float(area_uv[sel].sum()))
+    return stats
+
+
+def image_source_hash(img):
+    """基于原始压缩数据（packed 或磁盘文件）计算图像哈希，作为跨任务缓存键"""
+    h = hashlib.sha1()
+    if img.packed_file is not None:
+        h.update(img.packed_file.data)
+    else:
+        path = bpy.path.abspath(img.filepath)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def resample_factor(img, area3d, area_uv, total_area):
+    """估计烘焙实际需要的纹素密度，返回 2 的幂整数降采样倍数（1 表示保持原样）"""
+    w, h = img.size
+    if w == 0 or h == 0 or area_uv <= 0 or total_area <= 0:
+        return 1
+    # 该图覆盖的面在烘焙图中大约分到的纹素数 / 源图在这些面上提供的纹素数
+    needed = BAKE_RESOLUTION * BAKE_RESOLUTION * area3d / total_area
+    provided = w * h * area_uv
+    scale = (needed / provided) ** 0.5 * TEXTURE_RESAMPLE_SAFETY
+    f = 1
+    while scale * f * 2 <= 1.0 and min(w, h) // (f * 2) >= TEXTURE_MIN_SIZE:
+        f *= 2
+    # 只做整倍数盒式降采样
+    while f > 1 and (w % f or h % f):
+        f //= 2
+    return f
+
+
+def box_downsample(pixels, w, h, f, srgb=False, band_rows=256):
+    """向量化盒式滤波：(h*w*4,) → (h/f, w/f, 4)。
+    srgb 为 True 时 RGB 先解码到线性空间再平均；按行带处理，临时数组只有一个行带大小"""
+    src = pixels.reshape(h, w, 4)
+    out = np.empty((h // f, w // f, 4), dtype=np.float32)
+    band = max(1, band_rows // f) * f
+    for y in range(0, h, band):
+        block = src[y:y + band]
+        if srgb:
+            block = np.concatenate([srgb_to_linear(block[..., :3]), block[..., 3:]], axis=-1)
+        small = block.reshape(-1, f, w // f, f, 4).mean(axis=(1, 3), dtype=np.float32)
+        if srgb:
+            small[..., :3] = linear_to_srgb(small[..., :3])
+        out[y // f:(y + band) // f] = small
+    return out
+
+
+def resample_source_textures(meshes, cache_dir):
+    stats = material_surface_stats(meshes)
+    total_area = sum(a3 for a3, _ in stats.values())
+
+    # 汇总每张图被哪些材质使用
+    usage = {}
+    for mat in bpy.data.materials:
+        if not mat.use_nodes or mat.node_tree is None or mat.name not in stats:
+            continue
+        for node in mat.node_tree.nodes:
+            if node.type == 'TEX_IMAGE' and node.image is not None and node.image.source == 'FILE':
+                a3, auv = usage.get(node.image.name, (0.0, 0.0))
+                m3, muv = stats[mat.name]
+                usage[node.image.name] = (a3 + m3, auv + muv)
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    for name, (area3d, area_uv) in usage.items():
+        img = bpy.data.images[name]
+        f = resample_factor(img, area3d, area_uv, total_area)
+        if f == 1:
+            continue
+        w, h = img.size
+        nw, nh = w // f, h // f
+
+        key = image_source_hash(img) if cache_dir else None
+        cache_path = os.path.join(cache_dir, f"{key}_{nw}x{nh}.npy") if key else None
+        if cache_path and os.path.exists(cache_path):
+            small = np.load(cache_path)
+            source = "cache"
+        else:
+            pixels = np.empty(w * h * 4, dtype=np.float32)
+            img.pixels.foreach_get(pixels)
+            srgb = not img.is_float and img.colorspace_settings.name == 'sRGB'
+            small = box_downsample(pixels, w, h, f, srgb=srgb)
+            del pixels
+            if not img.is_float:
+                # 字节图本身只有 8 位精度，按 uint8 存储（缓存体积为 float32 的 1/4）
+                small = np.rint(small * 255.0).astype(np.uint8)
+            if cache_path:
+                # 先写临时文件再替换，避免并发任务读到半个文件
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+                np.save(tmp_path, small)
+                os.replace(tmp_path, cache_path)
+            source = "computed"
+        if small.dtype == np.uint8:
+            buf = np.empty(small.size, dtype=np.float32)
+            np.multiply(small.ravel(), np.float32(1.0 / 255.0), out=buf, casting='unsafe')
+            small = buf
+
+        new_img = bpy.data.images.new(f"{name}_{nw}x{nh}", width=nw, height=nh,
+                                      alpha=True, float_buffer=img.is_float)
+        new_img.colorspace_settings.name = img.colorspace_settings.name
+        new_img.alpha_mode = img.alpha_mode
+        new_img.pixels.foreach_set(small.ravel())
+        img.user_remap(new_img)
+        bpy.data.images.remove(img)
+        print(f"[Debug] Resampled texture {name}: {w}x{h} → {nw}x{nh} ({source})")
+# ────────────────────────────────────────────────────────────────────────────────
+
+# ─── UV 展开后端 ────────────────────────────────────────────────────────────────
+
+def uv_is_reusable(tri_uv, tri_co, res=1024, tol=1e-3):
+    """向量化重叠检测：UV 必须全部落在 [0,1] 内，
+    且被多个三角形覆盖的像素中心不超过覆盖像素的 tol。
+    光栅化会丢掉零面积 UV 三角形，所以另外要求有实际 3D 面积的三角形都有 UV 面积
+    （没有 UV 图层的部件合并后 UV 全为 0，这些面烘焙时拿不到任何纹素）"""
+    if len(tri_uv) == 0 or tri_uv.min() < 0.0 or tri_uv.max() > 1.0:
+        return False
+    e1, e2 = tri_uv[:, 1] - tri_uv[:, 0], tri_uv[:, 2] - tri_uv[:, 0]
+    uv_area = 0.5 * np.abs(e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0])
+    area3d = 0.5 * np.linalg.norm(np.cross(tri_co[:, 1] - tri_co[:, 0], tri_co[:, 2] - tri_co[:, 0]), axis=1)
+    extent = float(np.ptp(tri_co.reshape(-1, 3), axis=0).max())
+    surface = area3d > 1e-10 * extent * extent
+    # 与 rasterize_uv_coverage 相同的零面积判据：任何一个都不接受
+    if (surface & (uv_area <= 0.5e-12)).any():
+        return False
+    # 小于 1% 纹素的近零面积三角形不能占去太多表面积
+    tiny = surface & (uv_area * res * res < 0.01)
+    if area3d[tiny].sum() > tol * area3d[surface].sum():
+        return False
+    coverage = rasterize_uv_coverage(tri_uv, res, res)
+    covered = int((coverage > 0).sum())
+    overlapped = int((coverage > 1).sum())
+    return covered > 0 and overlapped <= tol * covered
+
+
+def unwrap_blender():
+    # 进入 Edit 模式，选中所有面 → 智能展开 → 两次打包岛屿
+    bpy.ops.object.mode_set(mode='EDIT')
+    bpy.ops.mesh.select_all(action='SELECT')
+
+    # 智能展开（angle_limit 和 island_margin 用默认值 66°, 0.02）
+    bpy.ops.uv.smart_project()
+    print(f"[Debug] smart_project used angle_limit=66°, island_margin=0.02")
+
+    # Pack 两次（每次先全选 UV）
+    for i in range(2):
+        bpy.ops.uv.select_all(action='SELECT')
+        bpy.ops.uv.pack_islands(margin=0)
+        print(f"[Debug] pack_islands #{i + 1} margin=0")
+
+    bpy.ops.object.mode_set(mode='OBJECT')
+
+
+def unwrap_xatlas(obj, uv_name):
+    """xatlas 多线程分块 + 打包，结果按 loop 写回 uv_name 图层"""
+    import xatlas
+
+    me = obj.data
+    me.calc_loop_triangles()
+    n = len(me.loop_triangles)
+    tri_verts = np.empty(n * 3, dtype=np.uint32)
+    tri_loops = np.empty(n * 3, dtype=np.int32)
+    me.loop_triangles.foreach_get('vertices', tri_verts)
+    me.loop_triangles.foreach_get('loops', tri_loops)
+    co = np.empty(len(me.vertices) * 3, dtype=np.float32)
+    me.vertices.foreach_get('co', co)
+
+    atlas = xatlas.Atlas()
+    atlas.add_mesh(co.reshape(-1, 3), tri_verts.reshape(-1, 3))
+    pack_options = xatlas.PackOptions()
+    pack_options.resolution = BAKE_RESOLUTION
+    pack_options.padding = BAKE_MARGIN
+    atlas.generate(xatlas.ChartOptions(), pack_options)
+    _, indices, uvs = atlas[0]
+    if len(indices) != n:
+        raise RuntimeError(f"xatlas returned {len(indices)} faces, expected {n}")
+
+    loop_uv = np.zeros((len(me.loops), 2), dtype=np.float32)
+    loop_uv[tri_loops] = uvs[indices.ravel()]
+    me.uv_layers[uv_name].data.foreach_set('uv', loop_uv.ravel())
+
+
+def unwrap_uv(obj, backend):
+    """按选择的后端生成 NEW_UV_NAME，返回实际使用的后端名"""
+    me = obj.data
+    if backend in ('reuse', 'auto'):
+        tri_uv = read_uv_triangles(me, OLD_UV_NAME)
+        if uv_is_reusable(tri_uv, read_co_triangles(me)):
+            uv = np.empty(len(me.loops) * 2, dtype=np.float32)
+            me.uv_layers[OLD_UV_NAME].data.foreach_get('uv', uv)
+            me.uv_layers[NEW_UV_NAME].data.foreach_set('uv', uv)
+            return 'reuse'
+        print(f"[Debug] {OLD_UV_NAME} overlaps, leaves [0,1] or has faces without UV area, cannot reuse")
+    if backend in ('xatlas', 'auto'):
+        try:
+            unwrap_xatlas(obj, NEW_UV_NAME)
+            return 'xatlas'
+        except Exception as e:
+            print(f"[Debug] xatlas unwrap unavailable ({e}), falling back to blender")
+    unwrap_blender()
+    return 'blender'
+# ────────────────────────────────────────────────────────────────────────────────
+
+# ─── 分块烘焙 ────────────────────────────────────────────────────────────────────
+# 把烘焙 UV 仿射映射到一个小的分块图上逐块烘焙，再拼回整图。
+# 每块四周多烘焙 border 像素，使 margin 扩边能看到相邻块的真实内容，块边界不产生接缝。
+# 分块只限制 Cycles 自身的烘焙缓冲；拼接用的整图缓冲仍随输出分辨率增长。
+
+def retarget_bake_nodes(src, dst):
+    """把各材质中选中的、指向 src 的 Image Texture 节点改指 dst，返回被修改的节点"""
+    targets = []
+    for mat in bpy.data.materials:
+        if mat.node_tree is None:
+            continue
+        node = mat.node_tree.nodes.active
+        if node is not None and node.type == 'TEX_IMAGE' and node.image == src:
+            node.image = dst
+            targets.append(node)
+    return targets
+
+
+def bake_image(img, bake_type):
+    """烘焙到 img（需已是各材质中选中的 Image Texture 节点）"""
+    tile = args.bake_tile_size
+    res_x, res_y = img.size
+    if tile <= 0 or tile >= max(res_x, res_y):
+        bpy.ops.object.bake(type=bake_type)
+        return
+
+    obj = bpy.context.view_layer.objects.active
+    me = obj.data
+    uv_layer = me.uv_layers.active
+    uv = np.empty(len(me.loops) * 2, dtype=np.float32)
+    uv_layer.data.foreach_get('uv', uv)
+    uv = uv.reshape(-1, 2)
+    res = np.array([res_x, res_y], dtype=np.float32)
+    tri_px = read_uv_triangles(me, uv_layer.name) * res
+    tri_lo = tri_px.min(axis=1)
+    tri_hi = tri_px.max(axis=1)
+
+    border = scene.render.bake.margin + 2
+    size = tile + 2 * border
+    tile_img = bpy.data.images.new(f"{img.name}_tile", width=size, height=size,
+                                   alpha=True, float_buffer=img.is_float)
+    tile_img.colorspace_settings.name = img.colorspace_settings.name
+
+    # 把各材质中选中的目标节点临时换成分块图
+    targets = retarget_bake_nodes(img, tile_img)
+
+    # 相邻面扩边会去块外采样，分块时改用 EXTEND
+    bake_settings = scene.render.bake
+    old_margin_type = getattr(bake_settings, 'margin_type', None)
+    if old_margin_type is not None:
+        bake_settings.margin_type = 'EXTEND'
+
+    # 字节图按 uint8 累积，写回时只再分配一个整图 float32 缓冲
+    if img.is_float:
+        acc = np.zeros((res_y, res_x, 4), dtype=np.float32)
+        acc[..., 3] = 1.0
+    else:
+        acc = np.zeros((res_y, res_x, 4), dtype=np.uint8)
+        acc[..., 3] = 255
+    tile_px = np.empty(size * size * 4, dtype=np.float32)
+    baked = 0
+    try:
+        for y0 in range(0, res_y, tile):
+            for x0 in range(0, res_x, tile):
+                ox, oy = x0 - border, y0 - border
+                # 跳过没有三角形落入的分块
+                hit = ((tri_hi[:, 0] >= ox) & (tri_lo[:, 0] <= ox + size) &
+                       (tri_hi[:, 1] >= oy) & (tri_lo[:, 1] <= oy + size))
+                if not hit.any():
+                    continue
+                tile_uv = (uv * res - np.array([ox, oy], dtype=np.float32)) / size
+                uv_layer.data.foreach_set('uv', tile_uv.ravel())
+                bpy.ops.object.bake(type=bake_type)
+                baked += 1
+
+                tile_img.pixels.foreach_get(tile_px)
+                w = min(tile, res_x - x0)
+                h = min(tile, res_y - y0)
+                inner = tile_px.reshape(size, size, 4)[border:border + h, border:border + w]
+                acc[y0:y0 + h, x0:x0 + w] = inner if img.is_float else np.rint(inner * 255.0)
+    finally:
+        uv_layer.data.foreach_set('uv', uv.ravel())
+        for node in targets:
+            node.image = img
+        if old_margin_type is not None:
+            bake_settings.margin_type = old_margin_type
+        bpy.data.images.remove(tile_img)
+
+    if img.is_float:
+        img.pixels.foreach_set(acc.ravel())
+    else:
+        buf = np.empty(acc.size, dtype=np.float32)
+        np.multiply(acc.ravel(), np.float32(1.0 / 255.0), out=buf, casting='unsafe')
+        del acc
+        img.pixels.foreach_set(buf)
+    img.update()
+    print(f"[Debug] Tiled {bake_type} bake of {img.name}: {baked} tiles of {size}px")
+# ────────────────────────────────────────────────────────────────────────────────
+
+# ─── 超采样抗锯齿与 mip 链 ──────────────────────────────────────────────────────
+# EMIT 通道以 1 采样在 k 倍分辨率烘焙，再按岛屿掩码降采样，代替提高 Cycles 采样数。
+
+def uv_island_mask(res_x, res_y):
+    me = bpy.context.view_layer.objects.active.data
+    return rasterize_uv_coverage(read_uv_triangles(me, me.uv_layers.active.name), res_x, res_y) > 0
+
+
+def save_mips(img, pixels, coverage, normal=False):
+    """把 mip 链（第 1 级起）保存为 PNG：<输出名>_<图像名>_mip<N>.png"""
+    base = os.path.splitext(OUTPUT_FILE)[0]
+    for level, px in enumerate(mip_pyramid(pixels, coverage), start=1):
+        if normal:
+            # 法线平均后重新归一化
+            n = px[..., :3] * 2.0 - 1.0
+            n /= np.maximum(np.linalg.norm(n, axis=-1, keepdims=True), 1e-6)
+            px[..., :3] = n * 0.5 + 0.5
+        h, w = px.shape[:2]
+        mip = bpy.data.images.new(f"{img.name}_mip{level}", width=w, height=h,
+                                  alpha=True, float_buffer=img.is_float)
+        mip.colorspace_settings.name = img.colorspace_settings.name
+        mip.pixels.foreach_set(px.ravel())
+        mip.filepath_raw = f"{base}_{img.name}_mip{level}.png"
+        mip.file_format = 'PNG'
+        mip.save()
+        bpy.data.images.remove(mip)
+    print(f"[Debug] Saved mip chain for {img.name}")
+
+
+def bake_channel(img, bake_type):
+    """烘焙一个通道；EMIT 通道在 --supersample > 1 时超采样，--export_mips 时保存 mip 链"""
+    k = args.supersample
+    res_x, res_y = img.size
+    if bake_type != 'EMIT' or k <= 1:
+        bake_image(img, bake_type)
+        if args.export_mips:
+            pixels = np.empty(res_x * res_y * 4, dtype=np.float32)
+            img.pixels.foreach_get(pixels)
+            save_mips(img, pixels.reshape(res_y, res_x, 4), uv_island_mask(res_x, res_y),
+                      normal=bake_type == 'NORMAL')
+        return
+
+    hi = bpy.data.images.new(f"{img.name}_ss", width=res_x * k, height=res_y * k,
+                             alpha=True, float_buffer=img.is_float)
+    hi.colorspace_settings.name = img.colorspace_settings.name
+    targets = retarget_bake_nodes(img, hi)
+    old_samples = scene.cycles.samples
+    old_margin = scene.render.bake.margin
+    scene.cycles.samples = 1
+    scene.render.bake.margin = old_margin * k
+    t0 = time.perf_counter()
+    try:
+        bake_image(hi, bake_type)
+    finally:
+        scene.cycles.samples = old_samples
+        scene.render.bake.margin = old_margin
+        for node in targets:
+            node.image = img
+
+    pixels = np.empty(res_x * k * res_y * k * 4, dtype=np.float32)
+    hi.pixels.foreach_get(pixels)
+    bpy.data.images.remove(hi)
+    out, coverage = downsample_masked(pixels.reshape(res_y * k, res_x * k, 4),
+                                      uv_island_mask(res_x * k, res_y * k), k, args.ss_filter)
+    del pixels
+    img.pixels.foreach_set(out.ravel())
+    img.update()
+    print(f"[Debug] Supersampled {img.name}: {k}x, {args.ss_filter}, {time.perf_counter() - t0:.2f}s")
+    if args.export_mips:
+        save_mips(img, out, coverage)
+# ────────────────────────────────────────────────────────────────────────────────
+
+# ─── 网格合并 ────────────────────────────────────────────────────────────────────
+# 数千个小物体时，bpy.ops.object.join 和逐对象的 Python 循环远超线性增长。
+# 这里用 foreach_get 读出每个物体的数组，NumPy 拼接后一次 foreach_set 构建合并网格。
+
+def join_meshes_ops(meshes):
+    """原流程：逐对象整理 UV / 颜色图层后用 bpy.ops.object.join 合并"""
+    # 5. Keep only the first UV layer on each mesh (create one if missing)
+    for obj in meshes:
+        uv_layers = obj.data.uv_layers
+        # Add a UV layer if none exist
+        if len(uv_layers) == 0:
+            uv_layers.new(name=OLD_UV_NAME)
+        elif len(uv_layers) > 1:
+            # Remove extra UV layers by index in reverse order (no errors)
+            for idx in range(len(uv_layers) - 1, 0, -1):
+                uv_layers.remove(uv_layers[idx])
+        # Rename the remaining (first) UV layer
+        uv_layers[0].name = OLD_UV_NAME
+
+    # 6. Rename all original UV to a common name
+    for obj in meshes:
+        obj.data.uv_layers[0].name = OLD_UV_NAME
+
+    # Ensure each mesh has a vertex color layer named "Col" so join preserves per-vertex colors
+    for obj in meshes:
+        if hasattr(obj.data, "color_attributes"):
+            # Remove extra layers, keep one
+            for layer in list(obj.data.color_attributes)[1:]:
+                obj.data.color_attributes.remove(layer)
+            # Rename or create
+            if obj.data.color_attributes:
+                obj.data.color_attributes[0].name = "Col"
+            else:
+                layer = obj.data.color_attributes.new(name="Col", type='FLOAT_COLOR', domain='CORNER')
+                for poly in obj.data.polygons:
+                    for li in poly.loop_indices:
+                        layer.data[li].color = (1.0, 1.0, 1.0, 1.0)
+        else:
+            # Fallback for older versions
+            vcols = obj.data.vertex_colors
+            for layer in list(vcols)[1:]:
+                obj.data.vertex_colors.remove(layer)
+            if vcols:
+                vcols[0].name = "Col"
+            else:
+                layer = obj.data.vertex_colors.new(name="Col")
+                for poly in obj.data.polygons:
+                    for li in poly.loop_indices:
+                        layer.data[li].color = (1.0, 1.0, 1.0, 1.0)
+
+
+    # 7. Join all meshes into one
+    bpy.ops.object.select_all(action='DESELECT')
+    for obj in meshes:
+        obj.select_set(True)
+    bpy.context.view_layer.objects.active = meshes[0]
+    bpy.ops.object.join()
+    return bpy.context.view_layer.objects.active
+
+
+def read_loop_normals(me):
+    normals = np.empty(len(me.loops) * 3, dtype=np.float32)
+    if hasattr(me, 'corner_normals'):
+        # Blender 4.1+
+        me.corner_normals.foreach_get('vector', normals)
+    else:
+        me.calc_normals_split()
+        me.loops.foreach_get('normal', normals)
+    return normals.reshape(-1, 3)
+
+
+def merge_meshes_array(meshes):
+    """与 join 等价：合并到 meshes[0]（保留其变换与父级），材质槽按首次出现顺序合并，
+    第一个 UV 图层写入 OLD_UV_NAME，并创建白色的 "Col" 颜色图层"""
+    target = meshes[0]
+    to_target = np.array(target.matrix_world.inverted(), dtype=np.float64)
+
+    materials, mat_lookup = [], {}
+    cos, loop_verts, loop_starts, mat_indices, smooth, uvs, normals = [], [], [], [], [], [], []
+    v_off = l_off = 0
+    for obj in meshes:
+        me = obj.data
+        nv, nl, npoly = len(me.vertices), len(me.loops), len(me.polygons)
+        if npoly == 0:
+            continue
+        rel = to_target @ np.array(obj.matrix_world, dtype=np.float64)
+        lin = rel[:3, :3]
+
+        co = np.empty(nv * 3, dtype=np.float32)
+        me.vertices.foreach_get('co', co)
+        co = co.reshape(-1, 3) @ lin.T + rel[:3, 3]
+
+        lv = np.empty(nl, dtype=np.int32)
+        me.loops.foreach_get('vertex_index', lv)
+        ls = np.empty(npoly, dtype=np.int32)
+        lt = np.empty(npoly, dtype=np.int32)
+        mi = np.empty(npoly, dtype=np.int32)
+        sm = np.empty(npoly, dtype=bool)
+        me.polygons.foreach_get('loop_start', ls)
+        me.polygons.foreach_get('loop_total', lt)
+        me.polygons.foreach_get('material_index', mi)
+        me.polygons.foreach_get('use_smooth', sm)
+
+        uv = np.zeros(nl * 2, dtype=np.float32)
+        if len(me.uv_layers) > 0:
+            me.uv_layers[0].data.foreach_get('uv', uv)
+        uv = uv.reshape(-1, 2)
+
+        # 法线用逆转置矩阵变换
+        nrm = read_loop_normals(me) @ np.linalg.inv(lin)
+        nrm /= np.maximum(np.linalg.norm(nrm, axis=1, keepdims=True), 1e-12)
+
+        # 负缩放时翻转每个面的环绕顺序，与 join 保持一致
+        if np.linalg.det(lin) < 0:
+            poly = np.repeat(np.arange(npoly), lt)
+            k = np.arange(nl) - ls[poly]
+            perm = ls[poly] + lt[poly] - 1 - k
+            lv, uv, nrm = lv[perm], uv[perm], nrm[perm]
+
+        # 材质槽映射到合并后的槽位
+        remap = []
+        for slot in obj.material_slots:
+            key = slot.material.name if slot.material else None
+            if key not in mat_lookup:
+                mat_lookup[key] = len(materials)
+                materials.append(slot.material)
+            remap.append(mat_lookup[key])
+        mi = np.array(remap, dtype=np.int32)[np.clip(mi, 0, len(remap) - 1)] if remap else np.zeros(npoly, dtype=np.int32)
+
+        cos.append(co.astype(np.float32))
+        loop_verts.append(lv + v_off)
+        loop_starts.append(ls + l_off)
+        mat_indices.append(mi)
+        smooth.append(sm)
+        uvs.append(uv)
+        normals.append(nrm.astype(np.float32))
+        v_off += nv
+        l_off += nl
+
+    co = np.concatenate(cos)
+    lv = np.concatenate(loop_verts)
+    ls = np.concatenate(loop_starts)
+    lt = np.diff(np.append(ls, len(lv))).astype(np.int32)
+
+    me = bpy.data.meshes.new(target.data.name)
+    me.vertices.add(len(co))
+    me.vertices.foreach_set('co', co.ravel())
+    me.loops.add(len(lv))
+    me.loops.foreach_set('vertex_index', lv)
+    me.polygons.add(len(ls))
+    me.polygons.foreach_set('loop_start', ls)
+    if not me.polygons.bl_rna.properties['loop_total'].is_readonly:
+        me.polygons.foreach_set('loop_total', lt)
+    me.polygons.foreach_set('material_index', np.concatenate(mat_indices))
+    me.polygons.foreach_set('use_smooth', np.concatenate(smooth))
+    me.update(calc_edges=True)
+
+    uv_layer = me.uv_layers.new(name=OLD_UV_NAME)
+    uv_layer.data.foreach_set('uv', np.concatenate(uvs).ravel())
+    me.color_attributes.new(name="Col", type='FLOAT_COLOR', domain='CORNER')
+
+    if hasattr(me, 'use_auto_smooth'):
+        me.use_auto_smooth = True
+    me.normals_split_custom_set(np.concatenate(normals))
+
+    for mat in materials:
+        me.materials.append(mat)
+
+    # 用新网格替换目标物体的数据，删除其余物体及其网格
+    old_meshes = {obj.data for obj in meshes}
+    target.data = me
+    bpy.data.batch_remove([obj for obj in meshes[1:]])
+    bpy.data.batch_remove([m for m in old_meshes if m.users == 0])
+
+    bpy.ops.object.select_all(action='DESELECT')
+    target.select_set(True)
+    bpy.context.view_layer.objects.active = target
+    return target
+# ────────────────────────────────────────────────────────────────────────────────
+
+# ─── 阶段检查点 ──────────────────────────────────────────────────────────────────
+# 每个阶段的结果按 (输入哈希, 该阶段真正依赖的参数) 缓存：
+#   join   → 合并后的 .blend（网格 + 导入的材质与贴图）
+#   unwrap → BakedUV 的逐 loop 坐标 .npy
+# 只改 --bake_resolution / --bake_margin 时从最深的有效检查点继续。
+# 默认关闭：join 检查点含打包的源贴图，体积与输入 GLB 相当，且不会自动淘汰；
+# 只在对同一批资产做参数扫描时传 --stage_cache_dir，扫描结束后整个目录可直接删除。
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stage_key(stage, *parts):
+    return f"{stage}_" + hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def save_checkpoint(path):
+    """另存当前场景为检查点；先写临时文件再替换，避免并发任务读到半个文件"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{os.path.splitext(path)[0]}.{os.getpid()}.tmp.blend"
+    bpy.ops.wm.save_as_mainfile(filepath=tmp_path, copy=True)
+    os.replace(tmp_path, path)
+
+
+def save_baked_uv(obj, path):
+    me = obj.data
+    uv = np.empty(len(me.loops) * 2, dtype=np.float32)
+    me.uv_layers[NEW_UV_NAME].data.foreach_get('uv', uv)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, uv)
+    os.replace(tmp_path, path)
+
+
+def load_baked_uv(obj, path):
+    """读回 BakedUV；loop 数不一致时返回 False（检查点与网格不匹配）"""
+    me = obj.data
+    uv = np.load(path)
+    if len(uv) != len(me.loops) * 2:
+        return False
+    me.uv_layers[NEW_UV_NAME].data.foreach_set('uv', uv)
+    return True
 # ────────────────────────────────────────────────────────────────────────────────
 
 prefs = bpy.context.preferences
@@ -85,73 +776,44 @@ for dev in cycles_prefs.devices:
 # 4. 把场景渲染设备设为 GPU
 bpy.context.scene.cycles.device = 'GPU'
 
-# 2. Clear existing objects
-bpy.ops.object.select_all(action='SELECT')
-bpy.ops.object.delete(use_global=False)
-
-# 3. Import GLB
-bpy.ops.import_scene.gltf(filepath=INPUT_FILE)
-
-# 4. Gather mesh objects
-meshes = [obj for obj in bpy.context.scene.objects if obj.type == 'MESH']
-if not meshes:
-    print("Error: no mesh objects found in imported file.")
-    sys.exit(1)
-
-# 5. Keep only the first UV layer on each mesh (create one if missing)
-for obj in meshes:
-    uv_layers = obj.data.uv_layers
-    # Add a UV layer if none exist
-    if len(uv_layers) == 0:
-        uv_layers.new(name=OLD_UV_NAME)
-    elif len(uv_layers) > 1:
-        # Remove extra UV layers by index in reverse order (no errors)
-        for idx in range(len(uv_layers) - 1, 0, -1):
-            uv_layers.remove(uv_layers[idx])
-    # Rename the remaining (first) UV layer
-    uv_layers[0].name = OLD_UV_NAME
-
-# 6. Rename all original UV to a common name
-for obj in meshes:
-    obj.data.uv_layers[0].name = OLD_UV_NAME
-
-# Ensure each mesh has a vertex color layer named "Col" so join preserves per-vertex colors
-for obj in meshes:
-    if hasattr(obj.data, "color_attributes"):
-        # Remove extra layers, keep one
-        for layer in list(obj.data.color_attributes)[1:]:
-            obj.data.color_attributes.remove(layer)
-        # Rename or create
-        if obj.data.color_attributes:
-            obj.data.color_attributes[0].name = "Col"
-        else:
-            layer = obj.data.color_attributes.new(name="Col", type='FLOAT_COLOR', domain='CORNER')
-            for poly in obj.data.polygons:
-                for li in poly.loop_indices:
-                    layer.data[li].color = (1.0, 1.0, 1.0, 1.0)
-    else:
-        # Fallback for older versions
-        vcols = obj.data.vertex_colors
-        for layer in list(vcols)[1:]:
-            obj.data.vertex_colors.remove(layer)
-        if vcols:
-            vcols[0].name = "Col"
-        else:
-            layer = obj.data.vertex_colors.new(name="Col")
-            for poly in obj.data.polygons:
-                for li in poly.loop_indices:
-                    layer.data[li].color = (1.0, 1.0, 1.0, 1.0)
+# 2–7. 导入并合并网格；阶段缓存命中时直接打开合并后的检查点
+input_hash = file_sha1(INPUT_FILE) if STAGE_CACHE else None
+join_key = stage_key('join', input_hash, args.join_backend, OLD_UV_NAME)
+join_checkpoint = os.path.join(STAGE_CACHE_DIR, f"{join_key}.blend") if STAGE_CACHE else None
+if STAGE_CACHE and os.path.exists(join_checkpoint):
+    bpy.ops.wm.open_mainfile(filepath=join_checkpoint, load_ui=False)
+    scene = bpy.context.scene
+    merged = bpy.context.view_layer.objects.active
+    print(f"[Debug] Resumed from join checkpoint {join_checkpoint}")
+else:
+    # 2. Clear existing objects
+    bpy.ops.object.select_all(action='SELECT')
+    bpy.ops.object.delete(use_global=False)
 
+    # 3. Import GLB
+    bpy.ops.import_scene.gltf(filepath=INPUT_FILE)
 
-# 7. Join all meshes into one
-bpy.ops.object.select_all(action='DESELECT')
-for obj in meshes:
-    obj.select_set(True)
-bpy.context.view_layer.objects.active = meshes[0]
-bpy.ops.object.join()
+    # 4. Gather mesh objects
+    meshes = [obj for obj in bpy.context.scene.objects if obj.type == 'MESH']
+    if not meshes:
+        print("Error: no mesh objects found in imported file.")
+        sys.exit(1)
+    # 只有点 / 线图元的 GLB 导入后网格没有面，无法展开和烘焙
+    if not any(len(obj.data.polygons) for obj in meshes):
+        print("Error: no mesh objects with faces found in imported file.")
+        sys.exit(1)
+
+    # 5–7. 合并所有网格（--join_backend：array 为 NumPy 一次性拼接，ops 为原 join 流程）
+    t0 = time.perf_counter()
+    if args.join_backend == 'ops':
+        merged = join_meshes_ops(meshes)
+    else:
+        merged = merge_meshes_array(meshes)
+    print(f"[Debug] Joined {len(meshes)} meshes with backend={args.join_backend} in {time.perf_counter() - t0:.2f}s")
+    if STAGE_CACHE:
+        save_checkpoint(join_checkpoint)
 
 # 8. 新建 UVMap，并切到它（bake 用的是 active_index）
-merged = bpy.context.view_layer.objects.active
 merged.data.uv_layers.new(name=NEW_UV_NAME)
 idx = merged.data.uv_layers.find(NEW_UV_NAME)
 merged.data.uv_layers.active_index = idx
@@ -161,32 +823,25 @@ print(f"[Debug] Active UV layer for bake: {merged.data.uv_layers.active.name}")
 if "Col" not in merged.data.color_attributes:
     merged.data.color_attributes.new(name="Col", type='FLOAT_COLOR', domain='CORNER')
 col_layer = merged.data.color_attributes["Col"]
-for poly in merged.data.polygons:
-    for li in poly.loop_indices:
-        col_layer.data[li].color = (1.0, 1.0, 1.0, 1.0)
-
-# 9. 进入 Edit 模式，选中所有面 → 智能展开 → 两次打包岛屿
-bpy.ops.object.mode_set(mode='EDIT')
-
-# 9.1 全选所有面
-bpy.ops.mesh.select_all(action='SELECT')
-
-# 9.2 智能展开（angle_limit 和 island_margin 用默认值 66°, 0.02）
-bpy.ops.uv.smart_project()
-print(f"[Debug] smart_project used angle_limit=66°, island_margin=0.02")
+col_layer.data.foreach_set('color', np.ones(len(col_layer.data) * 4, dtype=np.float32))
 
-# 9.3 Pack 第一次（确保 UV 全选）
-bpy.ops.uv.select_all(action='SELECT')
-bpy.ops.uv.pack_islands(margin=0)
-print(f"[Debug] pack_islands #1 margin=0")
+# 9. 生成烘焙 UV（后端可选，见 --uv_backend）
+# 只有 xatlas 打包依赖分辨率和边距
+unwrap_opts = (BAKE_RESOLUTION, BAKE_MARGIN) if args.uv_backend in ('xatlas', 'auto') else ()
+unwrap_key = stage_key('unwrap', join_key, args.uv_backend, *unwrap_opts)
+uv_checkpoint = os.path.join(STAGE_CACHE_DIR, f"{unwrap_key}_uv.npy") if STAGE_CACHE else None
+if STAGE_CACHE and os.path.exists(uv_checkpoint) and load_baked_uv(merged, uv_checkpoint):
+    print(f"[Debug] Resumed {NEW_UV_NAME} from checkpoint {uv_checkpoint}")
+else:
+    t0 = time.perf_counter()
+    used_backend = unwrap_uv(merged, args.uv_backend)
+    print(f"[Debug] UV unwrap backend={used_backend} took {time.perf_counter() - t0:.2f}s")
+    if STAGE_CACHE:
+        save_baked_uv(merged, uv_checkpoint)
 
-# 9.4 Pack 第二次（同样先全选 UV）
-bpy.ops.uv.select_all(action='SELECT')
-bpy.ops.uv.pack_islands(margin=0)
-print(f"[Debug] pack_islands #2 margin=0")
-
-# 9.5 回 Object 模式
-bpy.ops.object.mode_set(mode='OBJECT')
+# 9.1 按烘焙纹素密度预采样过大的源贴图（自带按图像哈希的缓存，不进阶段检查点）
+if not args.disable_texture_resample:
+    resample_source_textures([merged], TEXTURE_CACHE_DIR)
 
 # --- 法线贴图烘焙阶段 ---
 # 10. 创建法线烘焙目标图
@@ -209,7 +864,7 @@ for mat in bpy.data.materials:
 scene.cycles.bake_type = 'NORMAL'
 scene.cycles.bake_normal_space = 'TANGENT'
 scene.render.bake.margin = BAKE_MARGIN
-bpy.ops.object.bake(type='NORMAL')
+bake_channel(normal_img, 'NORMAL')
 
 # 烘焙完成后，恢复到 Emission 烘焙
 scene.cycles.bake_type = 'EMIT'
@@ -257,7 +912,7 @@ for mat in bpy.data.materials:
 # 12. Setup Bake settings and bake
 scene.cycles.bake_type = 'EMIT'
 scene.render.bake.margin = BAKE_MARGIN
-bpy.ops.object.bake(type='EMIT')
+bake_channel(bake_img, 'EMIT')
 
 # --- Metallic-Roughness Bake ---
 mr_img = bpy.data.images.new(MRBAKE_IMAGE_NAME,
@@ -309,7 +964,7 @@ for mat in bpy.data.materials:
 # set bake to emit and run metallic-roughness bake
 scene.cycles.bake_type = 'EMIT'
 scene.render.bake.margin = BAKE_MARGIN
-bpy.ops.object.bake(type='EMIT')
+bake_channel(mr_img, 'EMIT')
 
 # 13. Create final single material with Principled BSDF + baked texture
 final_mat = bpy.data.materials.new(FINAL_MAT_NAME)
@@ -398,6 +1053,14 @@ bpy.ops.export_scene.gltf(
     export_normals=True
 )
 
+# 导出后处理：焊接 / 顶点缓存重排 / 可选量化 / 紧凑 BIN
+if args.optimize_glb:
+    from optimize_glb import optimize_glb, report
+    optimized_path = OUTPUT_FILE.replace('.glb', '_opt.glb')
+    stats = optimize_glb(OUTPUT_FILE, optimized_path, quantize=args.quantize)
+    report(OUTPUT_FILE, optimized_path, stats)
+    os.replace(optimized_path, OUTPUT_FILE)
+
 # Save Blender project for inspection
 if not args.disable_export_debug:
     bpy.ops.wm.save_mainfile(filepath=BLEND_SAVE_PATH)
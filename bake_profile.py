@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# bake_profile.py
+#
+# bake_glb.py / advanced_bake.py 的可选性能剖析（在 Blender 内部运行，外部 profiler 不好挂载）：
+#   <base>.pstats     cProfile 结果，可用 pstats / snakeviz 查看
+#   <base>.collapsed  flamegraph.pl / speedscope 可读的 collapsed-stack 格式
+# bpy.ops 调用会按 "bpy.ops.<idname>@<调用文件>:<行号>" 单独计时，能看出是哪一行的哪个算子慢。
+import os
+import sys
+import time
+import types
+import atexit
+import cProfile
+import pstats
+from collections import defaultdict
+
+MAX_DEPTH = 64          # collapsed 栈的最大深度
+MIN_STACK_US = 100      # 小于该耗时（微秒）的调用路径不展开
+
+
+def _op_frame(call, args, kwargs):
+    return call(*args, **kwargs)
+
+
+_op_frames = {}
+
+
+def _labelled_op_frame(idname, caller):
+    """为每个 (算子, 调用位置) 生成一个独立命名的代码对象，使 cProfile 分开统计"""
+    key = (idname, caller)
+    if key not in _op_frames:
+        name = f"bpy.ops.{idname}@{caller}"
+        code = _op_frame.__code__.replace(co_name=name)
+        if hasattr(code, 'co_qualname'):
+            code = code.replace(co_qualname=name)
+        _op_frames[key] = types.FunctionType(code, _op_frame.__globals__, name)
+    return _op_frames[key]
+
+
+def install_op_hooks():
+    """包装 bpy.ops 的调用入口，返回恢复函数"""
+    from bpy.ops import _BPyOpsSubModOp
+
+    original = _BPyOpsSubModOp.__call__
+
+    def __call__(self, *args, **kwargs):
+        frame = sys._getframe(1)
+        caller = f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno}"
+        op_frame = _labelled_op_frame(self.idname_py(), caller)
+        return op_frame(lambda *a, **kw: original(self, *a, **kw), args, kwargs)
+
+    _BPyOpsSubModOp.__call__ = __call__
+
+    def restore():
+        _BPyOpsSubModOp.__call__ = original
+    return restore
+
+
+def _label(func):
+    filename, line, name = func
+    if filename == '~' or name.startswith('bpy.ops.'):
+        return name
+    return f"{os.path.basename(filename)}:{name}:{line}"
+
+
+def write_collapsed(stats, path):
+    """由 cProfile 的调用图近似还原调用栈：子调用按边上的累计时间比例分摊到各条路径，
+    每条路径输出一行 "a;b;c <微秒>"（自身耗时）"""
+    st = stats.stats
+    children = defaultdict(list)
+    for func, (_, _, _, _, callers) in st.items():
+        for caller, edge in callers.items():
+            children[caller].append((func, edge[3]))
+    lines = defaultdict(float)
+
+    def walk(func, path_time, stack, on_stack):
+        _, _, tt, ct, _ = st[func]
+        frac = path_time / ct if ct > 0 else 0.0
+        stack = stack + [_label(func)]
+        if tt * frac > 0:
+            lines[';'.join(stack)] += tt * frac
+        if len(stack) >= MAX_DEPTH:
+            return
+        for child, edge_ct in children.get(func, ()):
+            t = edge_ct * frac
+            if child in on_stack or t * 1e6 < MIN_STACK_US:
+                continue
+            on_stack.add(child)
+            walk(child, t, stack, on_stack)
+            on_stack.discard(child)
+
+    for func, (_, _, _, ct, callers) in st.items():
+        if not callers:
+            walk(func, ct, [], {func})
+
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, t in sorted(lines.items()):
+            us = int(round(t * 1e6))
+            if us > 0:
+                f.write(f"{stack} {us}\n")
+
+
+class PipelineProfiler:
+    """开启 cProfile 与 bpy.ops 计时；stop() 写出 <base>.pstats / <base>.collapsed。
+    threshold 不为 None 时，只有总耗时不少于 threshold 秒才写文件（供批处理自动抓慢任务）。
+    解释器退出时会自动 stop，sys.exit 提前退出的任务也能留下结果"""
+
+    def __init__(self, base, threshold=None):
+        self.base = base
+        self.threshold = threshold
+        self.profiler = cProfile.Profile()
+        self.restore = None
+        self.started = None
+
+    def start(self):
+        try:
+            self.restore = install_op_hooks()
+        except ImportError:
+            self.restore = None
+        self.started = time.perf_counter()
+        self.profiler.enable()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        if self.started is None:
+            return
+        self.profiler.disable()
+        elapsed = time.perf_counter() - self.started
+        self.started = None
+        if self.restore is not None:
+            self.restore()
+        if self.threshold is not None and elapsed < self.threshold:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.base)), exist_ok=True)
+        stats = pstats.Stats(self.profiler)
+        stats.dump_stats(f"{self.base}.pstats")
+        write_collapsed(stats, f"{self.base}.collapsed")
+        print(f"[Profile] {elapsed:.2f}s total, saved {self.base}.pstats / {self.base}.collapsed")
+        stats.sort_stats('cumulative').print_stats(20)
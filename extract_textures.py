@@ -5,6 +5,11 @@
 # 配置区 —— 在这里设置输入 GLB 路径和输出目录
 INPUT_GLB   = r"F:\AI\datasets\objaverse_result\xatlas_py\000a883519934f4383b9aeb0d535c545_baked.glb"
 OUTPUT_DIR  = r"F:\AI\datasets\objaverse_result\xatlas_py"
+# 分片归档（见 shard_archive.py）：
+#   ARCHIVE_DIR 不为 None 时，贴图写入 <ARCHIVE_DIR>/textures-*.tar 分片而不是零散文件
+#   BAKED_ARCHIVE_DIR 不为 None 时，忽略 INPUT_GLB，遍历 bake_all_glb.py 写出的 baked-*.tar 中的全部 GLB
+ARCHIVE_DIR       = None
+BAKED_ARCHIVE_DIR = None
 
 import os
 import json
@@ -12,33 +17,37 @@ import struct
 import base64
 import sys
 
+from shard_archive import ShardWriter, ShardReader
+
 def parse_glb(path):
     with open(path, 'rb') as f:
-        header = f.read(12)
-        magic, version, length = struct.unpack('<4sII', header)
-        if magic != b'glTF':
-            raise ValueError("Not a valid GLB file")
-        json_chunk = None
-        bin_chunk = None
-        offset = 12
-        while offset < length:
-            # 读取下一个 chunk 的头部：length (uint32) + type (4 chars)
-            chunk_header = f.read(8)
-            if len(chunk_header) < 8:
-                break
-            chunk_length, chunk_type = struct.unpack('<I4s', chunk_header)
-            chunk_data = f.read(chunk_length)
-            if chunk_type == b'JSON':
-                json_chunk = chunk_data
-            elif chunk_type.rstrip(b'\x00') == b'BIN':
-                bin_chunk = chunk_data
-            offset += 8 + chunk_length
-        if json_chunk is None:
-            raise ValueError("Missing JSON chunk in GLB")
-        # binary chunk may be None if all buffers are external
-        return json.loads(json_chunk.decode('utf-8')), bin_chunk
+        return parse_glb_bytes(f.read())
+
+def parse_glb_bytes(data):
+    magic, version, length = struct.unpack_from('<4sII', data, 0)
+    if magic != b'glTF':
+        raise ValueError("Not a valid GLB file")
+    json_chunk = None
+    bin_chunk = None
+    offset = 12
+    while offset < length:
+        # 读取下一个 chunk 的头部：length (uint32) + type (4 chars)
+        if offset + 8 > len(data):
+            break
+        chunk_length, chunk_type = struct.unpack_from('<I4s', data, offset)
+        chunk_data = bytes(data[offset + 8:offset + 8 + chunk_length])
+        if chunk_type == b'JSON':
+            json_chunk = chunk_data
+        elif chunk_type.rstrip(b'\x00') == b'BIN':
+            bin_chunk = chunk_data
+        offset += 8 + chunk_length
+    if json_chunk is None:
+        raise ValueError("Missing JSON chunk in GLB")
+    # binary chunk may be None if all buffers are external
+    return json.loads(json_chunk.decode('utf-8')), bin_chunk
 
-def extract_image(image_index, gltf, bin_chunk, out_base):
+def read_image(image_index, gltf, bin_chunk):
+    """返回 (图像字节, 扩展名)"""
     img_def = gltf['images'][image_index]
     # 优先 bufferView
     if 'bufferView' in img_def:
@@ -75,16 +84,20 @@ def extract_image(image_index, gltf, bin_chunk, out_base):
         else:
             ext = 'bin'
 
+    return data, ext
+
+def extract_image(image_index, gltf, bin_chunk, out_base, archive=None):
+    """写出图像：archive 为 ShardWriter 时写入分片（成员名为文件名），否则写零散文件"""
+    data, ext = read_image(image_index, gltf, bin_chunk)
     out_path = f"{out_base}.{ext}"
+    if archive is not None:
+        archive.add_bytes(os.path.basename(out_path), data)
+        return f"{archive.prefix}-{archive.shard_id:06d}.tar:{os.path.basename(out_path)}"
     with open(out_path, 'wb') as wf:
         wf.write(data)
     return out_path
 
-def main():
-    gltf, bin_chunk = parse_glb(INPUT_GLB)
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    base = os.path.splitext(os.path.basename(INPUT_GLB))[0]
-
+def extract_textures(gltf, bin_chunk, base, archive=None):
     # 假设只有一个材质
     mats = gltf.get('materials', [])
     if not mats:
@@ -98,7 +111,7 @@ def main():
     if bc_tex is not None:
         img_idx = gltf['textures'][bc_tex]['source']
         out = os.path.join(OUTPUT_DIR, f"{base}_albedo")
-        saved = extract_image(img_idx, gltf, bin_chunk, out)
+        saved = extract_image(img_idx, gltf, bin_chunk, out, archive)
         print(f"Saved Albedo → {saved}")
     else:
         print("Warning: 未找到 BaseColor 贴图")
@@ -108,7 +121,7 @@ def main():
     if normal_tex is not None:
         img_idx = gltf['textures'][normal_tex]['source']
         out = os.path.join(OUTPUT_DIR, f"{base}_normal")
-        saved = extract_image(img_idx, gltf, bin_chunk, out)
+        saved = extract_image(img_idx, gltf, bin_chunk, out, archive)
         print(f"Saved Normal → {saved}")
     else:
         print("Warning: 未找到 Normal 贴图")
@@ -118,10 +131,39 @@ def main():
     if mr_tex is not None:
         img_idx = gltf['textures'][mr_tex]['source']
         out = os.path.join(OUTPUT_DIR, f"{base}_mr")
-        saved = extract_image(img_idx, gltf, bin_chunk, out)
+        saved = extract_image(img_idx, gltf, bin_chunk, out, archive)
         print(f"Saved Metallic-Roughness → {saved}")
     else:
         print("Warning: 未找到 Metallic-Roughness 贴图")
 
+def main():
+    archive = ShardWriter(ARCHIVE_DIR, "textures") if ARCHIVE_DIR else None
+    if archive is None:
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+    reader = None
+    try:
+        if BAKED_ARCHIVE_DIR:
+            reader = ShardReader(BAKED_ARCHIVE_DIR, "baked")
+            failed = 0
+            for name in sorted(reader.names()):
+                # 单个成员损坏不中断整批
+                try:
+                    gltf, bin_chunk = parse_glb_bytes(reader.get(name))
+                    extract_textures(gltf, bin_chunk, os.path.splitext(name)[0], archive)
+                except Exception as e:
+                    failed += 1
+                    print(f"Error: 提取 {name} 失败：{e!r}")
+            if failed:
+                print(f"Warning: {failed} 个成员提取失败")
+        else:
+            gltf, bin_chunk = parse_glb(INPUT_GLB)
+            base = os.path.splitext(os.path.basename(INPUT_GLB))[0]
+            extract_textures(gltf, bin_chunk, base, archive)
+    finally:
+        if reader is not None:
+            reader.close()
+        if archive is not None:
+            archive.close()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# optimize_glb.py
+#
+# 基于 extract_textures.py 的 GLB chunk 解析，对导出的 GLB 做纯 Python / NumPy 后处理：
+#   1. 焊接完全相同的顶点
+#   2. 三角形按质心 Morton 码排序、顶点按首次使用排序，提高顶点缓存 / 取数局部性
+#   3. 可选 KHR_mesh_quantization：POSITION → uint16，NORMAL / TANGENT → int8，TEXCOORD → uint16
+#   4. 只写入仍被引用的数据，紧凑重写 BIN chunk
+# 配置区 —— 单独运行时在这里设置输入 / 输出 GLB
+INPUT_GLB  = r"F:\AI\datasets\objaverse_result\xatlas_py\000a883519934f4383b9aeb0d535c545_baked.glb"
+OUTPUT_GLB = r"F:\AI\datasets\objaverse_result\xatlas_py\000a883519934f4383b9aeb0d535c545_opt.glb"
+QUANTIZE   = False
+CACHE_SIZE = 32     # 统计 ACMR 用的 FIFO 顶点缓存大小
+
+import os
+import json
+import time
+import struct
+from collections import deque
+
+import numpy as np
+
+from extract_textures import parse_glb
+
+COMPONENT_DTYPES = {
+    5120: np.int8, 5121: np.uint8, 5122: np.int16,
+    5123: np.uint16, 5125: np.uint32, 5126: np.float32,
+}
+DTYPE_COMPONENTS = {np.dtype(v): k for k, v in COMPONENT_DTYPES.items()}
+TYPE_SIZES = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4, 'MAT2': 4, 'MAT3': 9, 'MAT4': 16}
+SIZE_TYPES = {1: 'SCALAR', 2: 'VEC2', 3: 'VEC3', 4: 'VEC4'}
+NORMALIZED_DIVISORS = {np.int8: 127.0, np.uint8: 255.0, np.int16: 32767.0, np.uint16: 65535.0}
+
+
+def read_accessor(gltf, bin_chunk, index):
+    """把 accessor 读成 (count, comps) 数组，保持原始分量类型"""
+    acc = gltf['accessors'][index]
+    if 'sparse' in acc:
+        raise ValueError(f"Accessor[{index}] 是 sparse，不支持")
+    dtype = np.dtype(COMPONENT_DTYPES[acc['componentType']])
+    comps = TYPE_SIZES[acc['type']]
+    count = acc['count']
+    if 'bufferView' not in acc:
+        return np.zeros((count, comps), dtype=dtype)
+    bv = gltf['bufferViews'][acc['bufferView']]
+    offset = bv.get('byteOffset', 0) + acc.get('byteOffset', 0)
+    stride = bv.get('byteStride', dtype.itemsize * comps)
+    arr = np.ndarray((count, comps), dtype=dtype, buffer=bin_chunk,
+                     offset=offset, strides=(stride, dtype.itemsize))
+    return np.array(arr)
+
+
+def to_float(arr, normalized):
+    """按 glTF 规则把（可能归一化的）整型数据解码成 float32"""
+    if arr.dtype == np.float32:
+        return arr
+    if normalized:
+        return np.maximum(arr.astype(np.float32) / NORMALIZED_DIVISORS[arr.dtype.type], -1.0)
+    return arr.astype(np.float32)
+
+
+def acmr(indices, cache_size=CACHE_SIZE):
+    """FIFO 顶点缓存模拟：平均每个三角形的缓存未命中数"""
+    cache = deque()
+    resident = set()
+    misses = 0
+    for v in indices.tolist():
+        if v not in resident:
+            misses += 1
+            cache.append(v)
+            resident.add(v)
+            if len(cache) > cache_size:
+                resident.discard(cache.popleft())
+    return misses / max(len(indices) // 3, 1)
+
+
+def morton_order(positions, tris):
+    """三角形按质心的 30 位 Morton 码排序"""
+    centroid = positions[tris].mean(axis=1)
+    lo = centroid.min(axis=0)
+    extent = np.maximum(centroid.max(axis=0) - lo, 1e-12)
+    q = ((centroid - lo) / extent * 1023).astype(np.uint32)
+
+    def spread(x):
+        x = (x | (x << 16)) & 0x030000FF
+        x = (x | (x << 8)) & 0x0300F00F
+        x = (x | (x << 4)) & 0x030C30C3
+        x = (x | (x << 2)) & 0x09249249
+        return x
+
+    code = spread(q[:, 0]) | (spread(q[:, 1]) << 1) | (spread(q[:, 2]) << 2)
+    return np.argsort(code, kind='stable')
+
+
+def optimize_primitive(attrs, indices):
+    """焊接 + 三角形重排 + 顶点按首次使用重排，返回 (attrs, indices)"""
+    n = len(next(iter(attrs.values())))
+    names = sorted(attrs)
+    # 焊接：所有属性的原始字节完全相同才视为同一顶点
+    key = np.ascontiguousarray(np.concatenate(
+        [np.ascontiguousarray(attrs[k]).view(np.uint8).reshape(n, -1) for k in names], axis=1))
+    key = key.view(np.dtype((np.void, key.shape[1]))).ravel()
+    _, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+    attrs = {k: v[first] for k, v in attrs.items()}
+    indices = inverse.ravel()[indices]
+
+    tris = indices.reshape(-1, 3)
+    if 'POSITION' in attrs and len(tris):
+        tris = tris[morton_order(attrs['POSITION'].astype(np.float32), tris)]
+    indices = tris.ravel()
+
+    # 顶点按在索引中首次出现的顺序排列，未被引用的顶点丢弃
+    used, first_use = np.unique(indices, return_index=True)
+    order = used[np.argsort(first_use)]
+    remap = np.empty(len(first), dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    return {k: v[order] for k, v in attrs.items()}, remap[indices]
+
+
+def quantize_attribute(name, arr, acc):
+    """KHR_mesh_quantization 允许的量化；返回 (数据, normalized)，不量化时返回 None"""
+    values = to_float(arr, acc.get('normalized', False))
+    if name in ('NORMAL', 'TANGENT'):
+        return np.round(np.clip(values, -1.0, 1.0) * 127.0).astype(np.int8), True
+    if name.startswith('TEXCOORD_') and values.min() >= 0.0 and values.max() <= 1.0:
+        return np.round(values * 65535.0).astype(np.uint16), True
+    return None
+
+
+class BinWriter:
+    """按 4 字节对齐追加数据，生成紧凑的 BIN chunk 与 bufferViews"""
+
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+        self.views = []
+
+    def add(self, data, stride=None, target=None):
+        pad = (-self.length) % 4
+        if pad:
+            self.chunks.append(b'\x00' * pad)
+            self.length += pad
+        view = {'buffer': 0, 'byteOffset': self.length, 'byteLength': len(data)}
+        if stride:
+            view['byteStride'] = stride
+        if target:
+            view['target'] = target
+        self.chunks.append(data)
+        self.length += len(data)
+        self.views.append(view)
+        return len(self.views) - 1
+
+    def add_accessor(self, accessors, arr, normalized=False, target=None, minmax=False):
+        """写入 (count, comps) 数组；顶点属性按 4 字节对齐补齐 stride"""
+        arr = np.ascontiguousarray(arr)
+        count, comps = arr.shape
+        acc = {
+            'componentType': DTYPE_COMPONENTS[arr.dtype],
+            'count': count,
+            'type': SIZE_TYPES[comps],
+        }
+        if normalized:
+            acc['normalized'] = True
+        if minmax:
+            acc['min'] = arr.min(axis=0).tolist()
+            acc['max'] = arr.max(axis=0).tolist()
+        elem = arr.dtype.itemsize * comps
+        stride = None
+        if target == 34962:
+            stride = (elem + 3) // 4 * 4
+            if stride != elem:
+                padded = np.zeros((count, stride), dtype=np.uint8)
+                padded[:, :elem] = arr.view(np.uint8).reshape(count, elem)
+                arr = padded
+        acc['bufferView'] = self.add(arr.tobytes(), stride=stride, target=target)
+        accessors.append(acc)
+        return len(accessors) - 1
+
+    def data(self):
+        pad = (-self.length) % 4
+        return b''.join(self.chunks) + b'\x00' * pad
+
+
+def write_glb(path, gltf, bin_data):
+    json_bytes = json.dumps(gltf, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    json_bytes += b' ' * ((-len(json_bytes)) % 4)
+    total = 12 + 8 + len(json_bytes) + (8 + len(bin_data) if bin_data else 0)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<4sII', b'glTF', 2, total))
+        f.write(struct.pack('<I4s', len(json_bytes), b'JSON'))
+        f.write(json_bytes)
+        if bin_data:
+            f.write(struct.pack('<I4s', len(bin_data), b'BIN\x00'))
+            f.write(bin_data)
+
+
+def measure_load_time(path):
+    """模拟下游加载：解析 GLB 并把所有网格 accessor 解码成 float32"""
+    t0 = time.perf_counter()
+    gltf, bin_chunk = parse_glb(path)
+    for mesh in gltf.get('meshes', []):
+        for prim in mesh.get('primitives', []):
+            refs = list(prim.get('attributes', {}).values())
+            if 'indices' in prim:
+                refs.append(prim['indices'])
+            for idx in refs:
+                acc = gltf['accessors'][idx]
+                to_float(read_accessor(gltf, bin_chunk, idx), acc.get('normalized', False))
+    return time.perf_counter() - t0
+
+
+def optimize_glb(src, dst, quantize=False):
+    """后处理 src 写到 dst，返回统计信息 dict"""
+    gltf, bin_chunk = parse_glb(src)
+    if any('uri' in b for b in gltf.get('buffers', [])):
+        raise ValueError("只支持数据全部在 BIN chunk 中的 GLB")
+    old_accessors = gltf.get('accessors', [])
+    old_views = gltf.get('bufferViews', [])
+    writer = BinWriter()
+    accessors = []
+    view_map = {}
+    accessor_map = {}
+
+    def keep_view(index):
+        """原样拷贝一个 bufferView"""
+        if index not in view_map:
+            bv = old_views[index]
+            start = bv.get('byteOffset', 0)
+            view_map[index] = writer.add(bin_chunk[start:start + bv['byteLength']],
+                                         stride=bv.get('byteStride'), target=bv.get('target'))
+        return view_map[index]
+
+    def keep_accessor(index):
+        """原样保留一个 accessor（连同它的 bufferView / sparse 数据）"""
+        if index not in accessor_map:
+            acc = dict(old_accessors[index])
+            if 'bufferView' in acc:
+                acc['bufferView'] = keep_view(acc['bufferView'])
+            if 'sparse' in acc:
+                sparse = json.loads(json.dumps(acc['sparse']))
+                sparse['indices']['bufferView'] = keep_view(sparse['indices']['bufferView'])
+                sparse['values']['bufferView'] = keep_view(sparse['values']['bufferView'])
+                acc['sparse'] = sparse
+            accessors.append(acc)
+            accessor_map[index] = len(accessors) - 1
+        return accessor_map[index]
+
+    skinned = {n['mesh'] for n in gltf.get('nodes', []) if 'mesh' in n and 'skin' in n}
+    dequant = {}
+    stats = {'vertices_before': 0, 'vertices_after': 0, 'acmr_before': [], 'acmr_after': []}
+
+    for mesh_idx, mesh in enumerate(gltf.get('meshes', [])):
+        prims = mesh.get('primitives', [])
+        rewritable = [p for p in prims
+                      if p.get('mode', 4) == 4 and 'targets' not in p and 'POSITION' in p.get('attributes', {})
+                      and not any('sparse' in old_accessors[i] for i in p['attributes'].values())]
+        rewritable_ids = {id(p) for p in rewritable}
+        can_quantize = bool(quantize and prims and mesh_idx not in skinned and len(rewritable) == len(prims))
+
+        # 同一网格的所有图元共用一个位置量化包围盒（通过节点变换反量化）。
+        # 三轴用同一个缩放：非均匀缩放会经逆转置矩阵改变法线 / 切线方向，扁平轴还会让矩阵接近奇异
+        if can_quantize:
+            pos = np.concatenate([to_float(read_accessor(gltf, bin_chunk, p['attributes']['POSITION']), False)
+                                  for p in prims])
+            lo = pos.min(axis=0)
+            scale = max(float((pos.max(axis=0) - lo).max()), 1e-12) / 65535.0
+            dequant[mesh_idx] = (lo, scale)
+
+        for prim in prims:
+            if id(prim) not in rewritable_ids:
+                prim['attributes'] = {k: keep_accessor(v) for k, v in prim['attributes'].items()}
+                if 'indices' in prim:
+                    prim['indices'] = keep_accessor(prim['indices'])
+                if 'targets' in prim:
+                    prim['targets'] = [{k: keep_accessor(v) for k, v in t.items()} for t in prim['targets']]
+                continue
+
+            attrs = {k: read_accessor(gltf, bin_chunk, v) for k, v in prim['attributes'].items()}
+            count = len(attrs['POSITION'])
+            if 'indices' in prim:
+                indices = read_accessor(gltf, bin_chunk, prim['indices']).ravel().astype(np.int64)
+            else:
+                indices = np.arange(count, dtype=np.int64)
+            stats['vertices_before'] += count
+            stats['acmr_before'].append((acmr(indices), len(indices) // 3))
+
+            attrs, indices = optimize_primitive(attrs, indices)
+            stats['vertices_after'] += len(attrs['POSITION'])
+            stats['acmr_after'].append((acmr(indices), len(indices) // 3))
+
+            new_attrs = {}
+            for name, arr in attrs.items():
+                acc = old_accessors[prim['attributes'][name]]
+                normalized = acc.get('normalized', False)
+                if can_quantize and name == 'POSITION':
+                    lo, scale = dequant[mesh_idx]
+                    arr = np.round((to_float(arr, False) - lo) / scale).astype(np.uint16)
+                    normalized = False
+                elif can_quantize:
+                    q = quantize_attribute(name, arr, acc)
+                    if q is not None:
+                        arr, normalized = q
+                new_attrs[name] = writer.add_accessor(accessors, arr, normalized=normalized,
+                                                      target=34962, minmax=name == 'POSITION')
+            prim['attributes'] = new_attrs
+            index_dtype = np.uint16 if len(attrs['POSITION']) < 65536 else np.uint32
+            prim['indices'] = writer.add_accessor(accessors, indices.astype(index_dtype).reshape(-1, 1),
+                                                  target=34963)
+
+    # 其余引用 accessor / bufferView 的地方原样保留
+    for skin in gltf.get('skins', []):
+        if 'inverseBindMatrices' in skin:
+            skin['inverseBindMatrices'] = keep_accessor(skin['inverseBindMatrices'])
+    for anim in gltf.get('animations', []):
+        for sampler in anim.get('samplers', []):
+            sampler['input'] = keep_accessor(sampler['input'])
+            sampler['output'] = keep_accessor(sampler['output'])
+    for img in gltf.get('images', []):
+        if 'bufferView' in img:
+            img['bufferView'] = keep_view(img['bufferView'])
+
+    # 量化网格：把 mesh 挪到一个携带反量化变换的子节点上
+    if dequant:
+        nodes = gltf['nodes']
+        for node in list(nodes):
+            mesh_idx = node.get('mesh')
+            if mesh_idx not in dequant:
+                continue
+            lo, scale = dequant[mesh_idx]
+            child = {'mesh': mesh_idx, 'translation': lo.tolist(), 'scale': [scale] * 3}
+            if 'weights' in node:
+                child['weights'] = node.pop('weights')
+            nodes.append(child)
+            node.setdefault('children', []).append(len(nodes) - 1)
+            del node['mesh']
+        for key in ('extensionsUsed', 'extensionsRequired'):
+            exts = gltf.setdefault(key, [])
+            if 'KHR_mesh_quantization' not in exts:
+                exts.append('KHR_mesh_quantization')
+
+    bin_data = writer.data()
+    gltf['accessors'] = accessors
+    gltf['bufferViews'] = writer.views
+    gltf['buffers'] = [{'byteLength': len(bin_data)}] if bin_data else []
+    if not gltf['accessors']:
+        del gltf['accessors']
+    if not gltf['bufferViews']:
+        del gltf['bufferViews']
+    if not gltf['buffers']:
+        del gltf['buffers']
+    write_glb(dst, gltf, bin_data)
+
+    def weighted(pairs):
+        tris = sum(t for _, t in pairs)
+        return sum(a * t for a, t in pairs) / tris if tris else 0.0
+
+    return {
+        'vertices_before': stats['vertices_before'],
+        'vertices_after': stats['vertices_after'],
+        'acmr_before': weighted(stats['acmr_before']),
+        'acmr_after': weighted(stats['acmr_after']),
+    }
+
+
+def report(src, dst, stats):
+    size_src, size_dst = os.path.getsize(src), os.path.getsize(dst)
+    load_src, load_dst = measure_load_time(src), measure_load_time(dst)
+    print(f"[Optimize] size {size_src / 1024:.1f} KB → {size_dst / 1024:.1f} KB "
+          f"({(size_dst - size_src) / max(size_src, 1) * 100:+.1f}%)")
+    print(f"[Optimize] vertices {stats['vertices_before']} → {stats['vertices_after']}, "
+          f"ACMR@{CACHE_SIZE} {stats['acmr_before']:.3f} → {stats['acmr_after']:.3f}")
+    print(f"[Optimize] load time {load_src * 1000:.1f} ms → {load_dst * 1000:.1f} ms")
+
+
+def main():
+    stats = optimize_glb(INPUT_GLB, OUTPUT_GLB, quantize=QUANTIZE)
+    report(INPUT_GLB, OUTPUT_GLB, stats)
+
+
+if __name__ == "__main__":
+    main()
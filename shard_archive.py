@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# shard_archive.py
+#
+# 把大量小文件（烘焙后的 GLB、提取的贴图）流式写入大小受限的 tar 分片，
+# 每个分片旁有一个索引文件（每行一个 JSON：name / offset / size），
+# 读取时 mmap 分片并按索引直接切片，O(1) 取出任意成员，无需解包。
+#
+#   <dir>/<prefix>-000000.tar
+#   <dir>/<prefix>-000000.idx
+import os
+import io
+import json
+import mmap
+import time
+import tarfile
+
+DEFAULT_MAX_BYTES = 4 << 30   # 单个分片上限 4 GB
+
+
+class ShardWriter:
+    """单写者：成员按顺序追加到当前分片，超过 max_bytes 时切换到下一个分片。
+    重新打开时接着写最后一个未满的分片"""
+
+    def __init__(self, directory, prefix, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.tar = None
+        self.index = None
+        os.makedirs(directory, exist_ok=True)
+        shards = sorted(f for f in os.listdir(directory)
+                        if f.startswith(prefix + "-") and f.endswith(".tar"))
+        self.shard_id = int(shards[-1][len(prefix) + 1:-4]) if shards else 0
+        self._open(append=bool(shards))
+
+    def _path(self, ext):
+        return os.path.join(self.directory, f"{self.prefix}-{self.shard_id:06d}.{ext}")
+
+    def _open(self, append):
+        if append and os.path.getsize(self._path("tar")) < self.max_bytes:
+            try:
+                self.tar = tarfile.open(self._path("tar"), mode='a')
+            except tarfile.TarError:
+                # 上次异常退出留下的残缺分片：不再追加，换新分片
+                self.tar = None
+        if self.tar is None:
+            if append:
+                self.shard_id += 1
+            self.tar = tarfile.open(self._path("tar"), mode='w')
+        self.index = open(self._path("idx"), 'a', encoding='utf-8')
+
+    def _roll(self):
+        self.close()
+        self.shard_id += 1
+        self._open(append=False)
+
+    def add_bytes(self, name, data):
+        """写入一个成员，返回 (分片号, 数据偏移, 大小)"""
+        if self.tar.offset > 0 and self.tar.offset + len(data) + 1024 > self.max_bytes:
+            self._roll()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+        # addfile 之后 offset 指向按 512 字节补齐的数据块末尾，由此倒推数据起点
+        offset = self.tar.offset - (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+        # 数据先落盘，再写索引：索引里的成员一定能读到
+        self.tar.fileobj.flush()
+        self.index.write(json.dumps({'name': name, 'offset': offset, 'size': len(data)},
+                                    ensure_ascii=False) + "\n")
+        self.index.flush()
+        return self.shard_id, offset, len(data)
+
+    def add_file(self, name, path):
+        with open(path, 'rb') as f:
+            return self.add_bytes(name, f.read())
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardReader:
+    """加载目录下所有分片索引；get(name) 通过 mmap 直接切片返回成员数据"""
+
+    def __init__(self, directory, prefix=None):
+        self.directory = directory
+        self.members = {}      # name -> (tar 路径, offset, size)
+        self.maps = {}
+        for fname in sorted(os.listdir(directory)):
+            if not fname.endswith(".idx") or (prefix and not fname.startswith(prefix + "-")):
+                continue
+            tar_path = os.path.join(directory, fname[:-4] + ".tar")
+            with open(os.path.join(directory, fname), 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    self.members[entry['name']] = (tar_path, entry['offset'], entry['size'])
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def names(self):
+        return self.members.keys()
+
+    def get(self, name):
+        tar_path, offset, size = self.members[name]
+        mm = self.maps.get(tar_path)
+        if mm is None:
+            with open(tar_path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[tar_path] = mm
+        return mm[offset:offset + size]
+
+    def close(self):
+        for mm in self.maps.values():
+            mm.close()
+        self.maps.clear()